@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+
+from itertools import product
+import numpy as np
+import pandas as pd
+
+import supervillain
+from supervillain.performance import Timer
+import results
+import catalog
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Finding κ_* by hand takes several campaigns: guess a grid, look at the finite-size scaling, guess a narrower bracket, repeat.
+# Instead we can start from a coarse grid of κ and let the data tell us where to look next.
+#
+# At κ_* the critical moments are scale-invariant, so the curves C(κ) for different N cross there.
+# We find the interval between neighboring κ in which the difference between the two largest N changes sign,
+# put new ensembles only inside that interval, and repeat until the interval is as narrow as we like.
+#
+# New rows are built from the input file's rows, so they are stored in the same files as the rest of the campaign,
+# and recorded in the catalog (see catalog.keep) so that reclaim.py keeps them.
+
+def rows(template, kappas, Ns):
+    ensembles = pd.DataFrame([template | {'kappa': kappa, 'N': N} for kappa, N in product(kappas, Ns)])
+    ensembles['path'] = ensembles.apply(lambda row:
+        f"W={row['W']}/kappa={row['kappa']:0.5f}/N={row['N']}/{row['action']}",
+        axis=1, raw=False
+        )
+    return ensembles
+
+def compute(ensembles, parallel=False):
+    import production
+    if parallel:
+        from parallel import Parallelize
+        from monitor import Monitor
+        import schedule
+        Parallelize(production.produce, monitor=Monitor(), by=schedule.families(ensembles))(ensembles, gather=('ensemble storage', 'bootstrap storage', ))
+    else:
+        from tqdm.contrib.logging import logging_redirect_tqdm
+        with logging_redirect_tqdm():
+            production.produce(ensembles)
+
+def crossing(data, observable):
+    r'''
+    The (lower, upper) κ between which the observable's curves for the two largest N cross, or None if they do not cross.
+    '''
+    Ns = sorted(data['N'].unique())
+    if len(Ns) < 2:
+        raise ValueError(f'Locating a crossing needs at least two lattice sizes, not N={Ns}.')
+    small, big = Ns[-2:]
+    curves = data.pivot_table(index='kappa', columns='N', values=observable).sort_index()
+    difference = (curves[big] - curves[small]).dropna()
+
+    sign = np.sign(difference.to_numpy())
+    changes = np.nonzero(sign[1:] * sign[:-1] < 0)[0]
+    if len(changes) == 0:
+        return None
+    if len(changes) > 1:
+        logger.warning(f'{observable} curves for N={small} and N={big} cross more than once; using the crossing with the largest κ.')
+
+    kappas = difference.index.to_numpy()
+    return (kappas[changes[-1]], kappas[changes[-1]+1])
+
+def bracket(data, observables):
+    # Each observable should cross in the same place; where they disagree we keep everything they suggest.
+    brackets = []
+    for o in observables:
+        if (b := crossing(data, o)) is not None:
+            logger.info(f'{o} crosses in {b}')
+            brackets.append(b)
+
+    if not brackets:
+        return None
+
+    lower = max(b[0] for b in brackets)
+    upper = min(b[1] for b in brackets)
+    if lower < upper:
+        return (lower, upper)
+
+    logger.warning(f'The observables cross in different intervals {brackets}.')
+    return (min(b[0] for b in brackets), max(b[1] for b in brackets))
+
+def refine(template, kappas, Ns, observables, tolerance, points=3, iterations=8, parallel=False, digits=5):
+
+    if len(set(Ns)) < 2:
+        raise ValueError(f'Locating a crossing needs at least two lattice sizes, not N={sorted(set(Ns))}.')
+
+    kappas = sorted(set(np.round(kappas, digits)))
+    b, data = None, None
+
+    for iteration in range(iterations):
+        with Timer(logger.info, f'Adaptive iteration {iteration} with κ={kappas}'):
+            ensembles = rows(template, kappas, Ns)
+            # These rows are in no input file; the catalog remembers them so that their data are not garbage-collected.
+            catalog.keep(ensembles, 'adaptive')
+            compute(ensembles, parallel=parallel)
+            data = results.collect(ensembles, observables=observables)
+
+        if (b := bracket(data, observables)) is None:
+            # κ_* is not inside the grid, so we widen it by a grid spacing on each side.
+            spacing = (kappas[1] - kappas[0], kappas[-1] - kappas[-2]) if len(kappas) > 1 else (kappas[0]/2, kappas[0]/2)
+            new = [kappas[0] - spacing[0], kappas[-1] + spacing[1]]
+            new = [k for k in new if k > 0]
+            logger.info(f'No crossing found; extending the grid by {new}.')
+        else:
+            lower, upper = b
+            logger.info(f'κ_* is between {lower} and {upper}.')
+            if upper - lower <= tolerance:
+                return b, data
+
+            new = np.linspace(lower, upper, points+2)[1:-1]
+
+        kappas = sorted(set(kappas) | set(np.round(new, digits)))
+
+    logger.warning(f'Did not reach a bracket narrower than {tolerance} in {iterations} iterations.')
+    return b, data
+
+if __name__ == '__main__':
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('input_file', type=supervillain.cli.input_file('input'), default='input.py')
+    parser.add_argument('--W', type=int, required=True)
+    parser.add_argument('--action', type=str, default='Worldline', choices=('Villain', 'Worldline'))
+    parser.add_argument('--kappa', type=float, nargs='+', required=True, help='The coarse starting grid.')
+    parser.add_argument('--N', type=int, nargs='+', required=True, help='Lattice sizes; the largest two locate the crossing.')
+    parser.add_argument('--observables', type=str, nargs='+', default=None, help='Defaults to SpinCriticalMoment, and also VortexCriticalMoment when W>1.')
+    parser.add_argument('--tolerance', type=float, default=0.01, help='Stop when κ_* is bracketed this tightly.')
+    parser.add_argument('--points', type=int, default=3, help='New κ per iteration.')
+    parser.add_argument('--iterations', type=int, default=8)
+    parser.add_argument('--parallel', default=False, action='store_true')
+
+    args = parser.parse_args()
+
+    if len(set(args.N)) < 2:
+        parser.error('Give at least two lattice sizes with --N; the crossing is between the largest two.')
+
+    ensembles = args.input_file.ensembles
+    template = ensembles[(ensembles['W'] == args.W) & (ensembles['action'] == args.action)]
+    if template.empty:
+        parser.error(f'The input file has no {args.action} ensembles with W={args.W} to use as a template.')
+    template = template.iloc[0].drop(['kappa', 'N', 'path']).to_dict()
+
+    observables = args.observables or (('SpinCriticalMoment', ) if args.W == 1 else ('SpinCriticalMoment', 'VortexCriticalMoment'))
+
+    if not args.parallel:
+        from tqdm.autonotebook import tqdm
+        import steps
+        steps.progress = tqdm
+
+    b, data = refine(template, args.kappa, args.N, observables, args.tolerance, points=args.points, iterations=args.iterations, parallel=args.parallel)
+
+    with pd.option_context('display.max_rows', None, 'display.width', 1000):
+        print(data[['kappa', 'N'] + [c for o in observables for c in (o, f'{o}±')]].sort_values(by=['kappa', 'N']))
+
+    print(f"kappas = {tuple(sorted(data['kappa'].unique()))}")
+    if b is not None:
+        print(f'brackets_critical = ({b[0]}, {(b[0]+b[1])/2:.5f}, {b[1]})')
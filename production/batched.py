@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+from collections import deque
+from itertools import product
+
+import numpy as np
+import pandas as pd
+
+import supervillain
+from supervillain.performance import Timer
+import steps
+import measurement
+from tempering import Replay
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Small lattices spend nearly all of their time in the interpreter rather than in numpy:
+# every update of every ensemble is its own handful of small array operations.
+# Rows with the same W, N, and action differ only in κ, so we can instead stack the fields of K ensembles along a leading axis
+# and update all of them at once, with κ broadcast along that axis.
+#
+# In the Villain frame the action is
+#
+#     S = κ/2 Σ_ℓ (dφ - 2π n)_ℓ^2 + (a phase that depends only on v and dn mod W)
+#
+# and the local updates
+#
+#   - φ → φ + δ u on every site of one color of a proper coloring of the lattice (so no two updated sites share a link), and
+#   - n → n ± W on every link,
+#
+# leave the phase alone, so each is an independent Metropolis accept/reject per site or link, which vectorizes perfectly.
+# The local updates cannot change v or the winding sectors, so every so often each replica also gets one of supervillain's
+# Hammer updates; the combination is correct because each update is.
+#
+# We do not take the form of the action on faith: before generating anything we check that our action differences
+# reproduce supervillain's for random changes to every replica, and refuse to run if they do not.
+
+def coloring(N):
+    # A proper coloring of a cycle of length N; odd cycles need a third color.
+    c = np.arange(N) % 2
+    if N % 2:
+        c[-1] = 2
+    return c
+
+class Batch:
+
+    def __init__(self, actions, delta=1., hammer=10, rng=None):
+        self.actions = actions
+        self.K = len(actions)
+        self.W = actions[0].W
+        self.kappa = np.array([S.kappa for S in actions])[:, None, None, None]  # [replica, μ, x, y]
+        self.delta = delta
+        self.hammer = hammer
+        self.hammers = [steps.construct('Villain', 'hammer', S) for S in actions]
+        self.rng = np.random.default_rng() if rng is None else rng
+
+        # Which way the lattice directions run; fixed by calibrate.
+        self.shift = -1
+        self.axes = (1, 2)
+
+        self.accepted = {'phi': np.zeros(self.K), 'n': np.zeros(self.K)}
+        self.proposed = {'phi': np.zeros(self.K), 'n': np.zeros(self.K)}
+
+    ####
+    #### Vectorized action
+    ####
+
+    def links(self, phi, n):
+        # (dφ - 2π n) on every link of every replica, [replica, μ, x, y].
+        d = np.stack([np.roll(phi, self.shift, axis=a) - phi for a in self.axes], axis=1)
+        return d - 2*np.pi*n
+
+    def energy(self, phi, n):
+        return self.kappa / 2 * self.links(phi, n)**2
+
+    def quadratic(self, phi, n):
+        return self.energy(phi, n).sum(axis=(1, 2, 3))
+
+    ####
+    #### Updates
+    ####
+
+    def site_update(self, phi, n):
+        N = phi.shape[-1]
+        c = coloring(N)
+        colors = c[:, None] + 3 * c[None, :]
+
+        before = self.energy(phi, n)
+        for color in np.unique(colors):
+            mask = (colors == color)[None, :, :]
+            proposal = phi + mask * self.rng.uniform(-self.delta, self.delta, phi.shape)
+
+            change = self.energy(proposal, n) - before
+            # Each site's change comes from its outgoing and incoming links.
+            local = sum(change[:, mu] + np.roll(change[:, mu], -self.shift, axis=a) for mu, a in enumerate(self.axes))
+
+            accept = mask & (self.rng.uniform(size=phi.shape) < np.exp(-local))
+            phi = np.where(accept, proposal, phi)
+            before = self.energy(phi, n)
+
+            self.accepted['phi'] += accept.sum(axis=(1, 2))
+            self.proposed['phi'] += mask.sum()
+
+        return phi
+
+    def link_update(self, phi, n):
+        step = self.W * self.rng.choice((-1, +1), size=n.shape)
+        change = self.energy(phi, n + step) - self.energy(phi, n)
+        accept = self.rng.uniform(size=n.shape) < np.exp(-change)
+
+        self.accepted['n'] += accept.sum(axis=(1, 2, 3))
+        self.proposed['n'] += n[0].size
+        return np.where(accept, n + step, n)
+
+    ####
+    #### Replicas
+    ####
+
+    @staticmethod
+    def fields(x):
+        return getattr(x, 'fields', x)
+
+    @staticmethod
+    def rebuild(x, phi, n):
+        fields = dict(Batch.fields(x)) | {'phi': phi, 'n': n}
+        return fields if Batch.fields(x) is x else x.__class__(fields)
+
+    def stack(self, xs):
+        return (
+            np.stack([np.asarray(self.fields(x)['phi'], dtype=float) for x in xs]),
+            np.stack([np.asarray(self.fields(x)['n']) for x in xs]),
+        )
+
+    def calibrate(self, xs, tolerance=1e-8):
+        r'''
+        Fix the lattice conventions so that our action differences match supervillain's for random changes to each replica,
+        or raise a ValueError if no convention does.
+        '''
+        phi, n = self.stack(xs)
+        new_phi = phi + self.rng.uniform(-1, 1, phi.shape)
+        new_n = n + self.W * self.rng.integers(-1, 2, n.shape)
+
+        exact = np.array([
+            (S(**self.fields(self.rebuild(x, p, m))) - S(**self.fields(x))).real
+            for S, x, p, m in zip(self.actions, xs, new_phi, new_n)
+            ])
+
+        for shift, axes in product((-1, +1), ((1, 2), (2, 1))):
+            self.shift, self.axes = shift, axes
+            ours = self.quadratic(new_phi, new_n) - self.quadratic(phi, n)
+            if np.allclose(ours, exact, rtol=tolerance, atol=tolerance * np.abs(exact).max()):
+                logger.debug(f'Batched update calibrated with shift {shift} and axes {axes}.')
+                return
+
+        raise ValueError(f'The batched Villain update does not reproduce the Villain action (differences {exact}); use the per-row generators instead.')
+
+    def sweeps(self, xs, count):
+        r'''
+        Advance every replica by count sweeps, each a local update of every φ and n, with a Hammer update every self.hammer sweeps.
+        '''
+        phi, n = self.stack(xs)
+        for sweep in range(count):
+            phi = self.site_update(phi, n)
+            n = self.link_update(phi, n)
+
+            if self.hammer and (sweep + 1) % self.hammer == 0:
+                xs = [G.step(self.rebuild(x, p, m)) for G, x, p, m in zip(self.hammers, xs, phi, n)]
+                phi, n = self.stack(xs)
+
+        return [self.rebuild(x, p, m) for x, p, m in zip(xs, phi, n)]
+
+    def acceptance(self):
+        return {k: self.accepted[k] / np.maximum(self.proposed[k], 1) for k in self.accepted}
+
+class Batched(Replay):
+
+    def report(self):
+        return f'Batched local updates over κ={self.kappas} recorded every {self.stride} sweeps; acceptance {self.acceptance}.'
+
+def generate(family):
+    r'''
+    Generates the production ensembles of every row in the family (which differ only in κ) together
+    and writes them to the rows' ensemble storage.
+
+    Every κ starts from its thermalized configuration and records a configuration every max(τ) sweeps,
+    where τ is the thermalized autocorrelation time.  Each row may set 'batch delta' (the φ proposal width, default 1)
+    and 'batch hammer' (the sweeps between Hammer updates, default 10; 0 for none) but the first row's choice is used.
+    '''
+    rows = [row for idx, row in family.sort_values(by='kappa').iterrows()]
+    template = rows[0]
+
+    actions = [steps.Action.of(row) for row in rows]
+    thermalized = [steps.Thermalization.of(row) for row in rows]
+    xs = [T.configuration[-1] for T in thermalized]
+
+    delta = template.get('batch delta', 1.)
+    hammer = template.get('batch hammer', 10)
+    B = Batch(actions,
+              delta=1. if pd.isna(delta) else float(delta),
+              hammer=10 if pd.isna(hammer) else int(hammer),
+              )
+    B.calibrate(xs)
+
+    stride = int(max(T.tau for T in thermalized))
+    configurations = max(int(row['configurations']) for row in rows)
+
+    chains = [deque() for _ in rows]
+    for configuration in steps.progress(range(configurations), desc='batched'):
+        xs = B.sweeps(xs, stride)
+        for chain, x in zip(chains, xs):
+            chain.append(x)
+
+    acceptance = B.acceptance()
+    logger.info(f"Batched acceptance: φ {acceptance['phi']} n {acceptance['n']}")
+
+    kappas = np.array([row['kappa'] for row in rows])
+    for row, S, T, chain in zip(rows, actions, thermalized, chains):
+        count = int(row['configurations'])
+        G = Batched(list(chain)[:count], stride, kappas, acceptance)
+
+        E = supervillain.Ensemble(S).generate(count, G, start=T.configuration[-1])
+        # Don't store the replayed configurations a second time.
+        del G.configurations
+
+        steps.Ensemble.write(row, steps.Ensemble.measure(E, measurement.declared(row, 'ensemble')))
+
+family = ['W', 'N', 'action']
+
+def produce(ensembles):
+    with Timer(logger.info, f'Batching {len(ensembles)} ensembles'):
+        for (W, N, action), rows in ensembles.groupby(family):
+            if action != 'Villain':
+                logger.info(f'Batched generation is only implemented in the Villain frame; leaving W={W} N={N} {action} to the usual Ensemble step.')
+                continue
+
+            missing = rows[[steps.Possible(steps.Ensemble).of(row) is None for idx, row in rows.iterrows()]]
+            if missing.empty:
+                logger.info(f'Every ensemble for W={W} N={N} {action} already exists.')
+                continue
+            if len(missing) < 2:
+                logger.info(f'Only one κ for W={W} N={N} {action}; leaving it to the usual Ensemble step.')
+                continue
+
+            with Timer(logger.info, f'Batching W={W} N={N} {action} over κ={tuple(missing["kappa"])}'):
+                try:
+                    generate(missing)
+                except ValueError as error:
+                    logger.error(error)
+
+if __name__ == '__main__':
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('input_file', type=supervillain.cli.input_file('input'), default='input.py')
+    parser.add_argument('--W', default=None, type=int)
+    parser.add_argument('--N', default=None, type=int, nargs='+', help='Batching pays off most for small lattices.')
+
+    args = parser.parse_args()
+
+    ensembles = args.input_file.ensembles
+    if args.W:
+        ensembles = ensembles[ensembles['W'] == args.W]
+    if args.N:
+        ensembles = ensembles[ensembles['N'].isin(args.N)]
+
+    from tqdm.autonotebook import tqdm
+    from tqdm.contrib.logging import logging_redirect_tqdm
+    steps.progress = tqdm
+
+    with logging_redirect_tqdm():
+        produce(ensembles)
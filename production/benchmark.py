@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import json
+import platform
+import tempfile
+from datetime import datetime
+from itertools import product
+from time import perf_counter, process_time
+
+import numpy as np
+import pandas as pd
+
+import supervillain
+from supervillain.performance import Timer
+import steps
+
+import logging
+logger = logging.getLogger(__name__)
+
+# To catch performance regressions when we upgrade supervillain (or anything else) we measure
+#
+#   - how many updates per second the Generator step makes, and
+#   - how many decorrelated configurations per second the DecorrelatedGenerator step makes,
+#
+# over a grid of lattice sizes, W, κ, and actions.  Each point is a row like the rows of an input file,
+# so that the steps construct exactly the generators a production run would use.
+# Thermalizations (which the DecorrelatedGenerator needs for τ) are stored in a scratch directory.
+
+def grid(N, W, kappa, action, sweeps, configurations, scratch, generator=('hammer', )):
+
+    defaults = {
+        'thermalization storage': f'{scratch}/thermalize.h5',
+        'ensemble storage':       f'{scratch}/ensemble.h5',
+        'bootstrap storage':      f'{scratch}/bootstrap.h5',
+        'thermalize': sweeps,
+        'thermalization cut': 1,
+        'configurations': configurations,
+        'bootstraps': 1,
+        'start': 'cold',
+    }
+
+    ensembles = pd.DataFrame([defaults | {'N': n, 'W': w, 'kappa': k, 'action': a, 'generator': g} for n, w, k, a, g in product(N, W, kappa, action, generator)])
+    # Each generator gets its own thermalization, since τ depends on the generator.
+    ensembles['path'] = ensembles.apply(lambda row:
+        f"W={row['W']}/kappa={row['kappa']:0.5f}/N={row['N']}/{row['action']}/{row['generator']}",
+        axis=1, raw=False
+        )
+    return ensembles
+
+def timed(f):
+    # Returns the wall-clock and cpu time it takes to call f().
+    wall, cpu = perf_counter(), process_time()
+    f()
+    return perf_counter() - wall, process_time() - cpu
+
+def measure(row, repeat=3):
+
+    S = steps.Action.of(row)
+    start = steps.Thermalization.of(row).configuration[-1]
+
+    G = steps.Generator.of(row)
+    sweeps = min(timed(lambda: supervillain.Ensemble(S).generate(row['thermalize'], G, start=start)) for _ in range(repeat))
+
+    D = steps.DecorrelatedGenerator.of(row)
+    decorrelated = min(timed(lambda: supervillain.Ensemble(S).generate(row['configurations'], D, start=start)) for _ in range(repeat))
+
+    return {
+        'N': int(row['N']),
+        'W': int(row['W']),
+        'kappa': float(row['kappa']),
+        'action': row['action'],
+        'generator': steps.generator(row),
+        'tau': int(D.stride),
+        'updates': int(row['thermalize']),
+        'updates wall': sweeps[0],
+        'updates cpu': sweeps[1],
+        'updates/s': row['thermalize'] / sweeps[0],
+        'configurations': int(row['configurations']),
+        'configurations wall': decorrelated[0],
+        'configurations cpu': decorrelated[1],
+        'configurations/s': row['configurations'] / decorrelated[0],
+    }
+
+def machine():
+    import os
+    return {
+        'time': datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'supervillain': getattr(supervillain, '__version__', 'unknown'),
+    }
+
+# Each result is identified by the point in parameter space it was measured at,
+key = ['N', 'W', 'kappa', 'action', 'generator']
+# and we watch the throughputs.
+rates = ['updates/s', 'configurations/s']
+
+def compare(results, baseline, tolerance=0.1):
+    r'''
+    Joins the results with the baseline, giving the ratio of each rate to the baseline and
+    marking as a regression any rate that has fallen by more than the tolerance.
+    '''
+    current = pd.DataFrame(results).set_index(key)[rates]
+    old = pd.DataFrame(baseline)
+    if 'generator' not in old.columns:
+        # Baselines from before generators were selectable all used the Hammer.
+        old['generator'] = 'hammer'
+    old = old.set_index(key)[rates]
+
+    comparison = current.join(old, rsuffix=' (baseline)', how='inner')
+    for r in rates:
+        comparison[f'{r} ratio'] = comparison[r] / comparison[f'{r} (baseline)']
+    comparison['regression'] = (comparison[[f'{r} ratio' for r in rates]] < 1 - tolerance).any(axis=1)
+    return comparison
+
+if __name__ == '__main__':
+
+    import sys
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('--N', default=(8, 16), type=int, nargs='+')
+    parser.add_argument('--W', default=(1, 2), type=int, nargs='+')
+    parser.add_argument('--kappa', default=(0.5, 0.74), type=float, nargs='+')
+    parser.add_argument('--action', default=('Villain', 'Worldline'), type=str, nargs='+', choices=('Villain', 'Worldline'))
+    parser.add_argument('--generator', default=('hammer', ), type=str, nargs='+', help="See steps.generators; 'auto' benchmarks whichever generator a short trial picks.")
+    parser.add_argument('--sweeps', default=100, type=int, help='Updates to time with the Generator; also used to thermalize.')
+    parser.add_argument('--configurations', default=20, type=int, help='Decorrelated configurations to time with the DecorrelatedGenerator.')
+    parser.add_argument('--repeat', default=3, type=int, help='Report the best of this many timings.')
+    parser.add_argument('--output', default='', type=str, help='Write the results to this JSON file.')
+    parser.add_argument('--baseline', default='', type=str, help='Compare against the results in this JSON file.')
+    parser.add_argument('--tolerance', default=0.1, type=float, help='Fractional slowdown relative to the baseline that counts as a regression.')
+
+    args = parser.parse_args()
+
+    # The thermalizations are written to a scratch directory which is deleted afterwards; don't catalog them.
+    steps.catalog.use('')
+
+    with tempfile.TemporaryDirectory() as scratch:
+        ensembles = grid(args.N, args.W, args.kappa, args.action, args.sweeps, args.configurations, scratch, generator=args.generator)
+
+        results = []
+        with Timer(logger.info, f'Benchmarking {len(ensembles)} generators'):
+            for idx, row in ensembles.iterrows():
+                with Timer(logger.info, f'Benchmarking W={row["W"]} N={row["N"]} κ={row["kappa"]:0.6f} {row["action"]} {row["generator"]}'):
+                    results.append(measure(row, repeat=args.repeat))
+                    logger.info(results[-1])
+
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 1000):
+        print(pd.DataFrame(results).set_index(key)[['tau'] + rates])
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'machine': machine(), 'results': results}, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        comparison = compare(results, baseline['results'], tolerance=args.tolerance)
+        print(f"Compared against {args.baseline} from {baseline['machine']['time']} on {baseline['machine']['host']} (supervillain {baseline['machine']['supervillain']})")
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 1000):
+            print(comparison)
+
+        if comparison['regression'].any():
+            logger.error(f"{comparison['regression'].sum()} of {len(comparison)} benchmarks regressed by more than {args.tolerance:.0%}.")
+            sys.exit(1)
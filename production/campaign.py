@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+from contextlib import contextmanager
+from pathlib import Path
+
+import matplotlib
+
+import supervillain
+from supervillain.performance import Timer
+import steps
+import results
+import catalog
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Running production.py, history.py, correlators.py, and scaling.py one after another on the same input file
+# pays for importing supervillain, pandas, h5py and matplotlib, executing the input file, and reading the same data
+# once per script.  Instead, the campaign driver runs any of those stages on any number of input files in one interpreter,
+# and remembers the Ensembles and Bootstraps it reads so that later stages get them for free (see steps.memory).
+#
+# The stages that make a figure are skipped if the figure is newer than all the data and input it depends on.
+
+class Campaign:
+
+    def __init__(self, input_file, stem, parallel=False, monitor=None, force=False):
+        self.input_file = input_file
+        self.stem = stem
+        self.parallel = parallel
+        self.monitor = monitor
+        self.force = force
+
+        self._collected = None
+
+    @property
+    def ensembles(self):
+        # The analysis stages read from wherever a --parallel computation wrote.
+        ensembles = self.input_file.ensembles
+        if self.parallel:
+            import parallel
+            ensembles = ensembles.apply(parallel.io_prep, axis=1)
+        return ensembles
+
+    def collect(self):
+        # Every plot that needs bootstrapped estimates can share one collection of all observables.
+        if self._collected is None:
+            self._collected = results.collect(self.ensembles)
+        return self._collected
+
+    def stale(self, output):
+        # A figure needs to be remade if it is older than the input file or any data it could depend on.
+        if self.force or not Path(output).exists():
+            return True
+
+        made = Path(output).stat().st_mtime
+        dependencies = [Path(f) for f in (getattr(self.input_file, '__file__', None), ) if f] + [
+            Path(f)
+            for column in self.ensembles.columns if 'storage' in column
+            for f in self.ensembles[column].unique()
+            ]
+        return any(d.exists() and d.stat().st_mtime > made for d in dependencies)
+
+    ####
+    #### Stages
+    ####
+
+    # Remembering what the generating stages compute would keep every row's thermalization in memory at once,
+    # and --parallel workers (or tempering replicas) would each inherit the memory; so they remember nothing.
+    @contextmanager
+    def forgetting(self):
+        remembered, steps.memory = steps.memory, None
+        try:
+            yield
+        finally:
+            steps.memory = remembered
+            # What was remembered may have been replaced on disk.
+            if steps.memory is not None:
+                steps.memory.clear()
+            # New data may have been written.
+            self._collected = None
+
+    def generate(self, produce, gather):
+        with self.forgetting():
+            if self.parallel:
+                from parallel import Parallelize
+                import schedule
+                ensembles = self.input_file.ensembles
+                Parallelize(produce, monitor=self.monitor, by=schedule.families(ensembles))(ensembles, gather=gather)
+            else:
+                from tqdm.contrib.logging import logging_redirect_tqdm
+                with logging_redirect_tqdm():
+                    produce(self.input_file.ensembles)
+
+    def thermalize(self):
+        import thermalize
+        self.generate(thermalize.produce, gather=('thermalization storage', ))
+
+    def temper(self):
+        # Tempering runs its own processes, one per κ, so it is the same with or without --parallel.
+        import tempering
+        with self.forgetting():
+            tempering.produce(self.input_file.ensembles)
+
+    def batch(self):
+        # Batching is cheapest in one process, so it is the same with or without --parallel.
+        import batched
+        with self.forgetting():
+            batched.produce(self.input_file.ensembles)
+
+    def produce(self):
+        import production
+        self.generate(production.produce, gather=('ensemble storage', 'bootstrap storage', ))
+
+    def history(self):
+        import history
+        with results.PDF(self.output('history')) as PDF:
+            history.create_pdf(results.ensembles(self.ensembles), PDF)
+
+    def correlators(self):
+        import correlators
+        results.pdf(self.output('correlators'), correlators.visualize(self.collect()))
+
+    def scaling(self):
+        import scaling
+        results.pdf(self.output('scaling'), scaling.visualize(self.collect()))
+
+    def transition(self):
+        import transition
+        results.pdf(self.output('transition'), transition.visualize(self.collect()))
+
+    def breaking(self):
+        # breaking.py sets usetex for its own figures, which we should not inflict on the other stages.
+        with matplotlib.rc_context():
+            import breaking
+            matplotlib.rcParams['text.usetex'] = True
+            matplotlib.rcParams['font.family'] = "Computer Modern Roman"
+            ensembles = self.ensembles
+            results.pdf(self.output('breaking'), breaking.visualize(ensembles[ensembles['action']=='Worldline']))
+
+    # The stages run in this order, whatever order they are requested in,
+    # and those with an output are skipped if the output is up to date.
+    # Every output is different, so that one stage neither overwrites another's figures nor is skipped because of them.
+    stages = {
+        'thermalize':  None,
+        'temper':      None,
+        'batch':       None,
+        'produce':     None,
+        'history':     '{stem}-history.pdf',
+        'correlators': '{stem}-correlators.pdf',
+        'scaling':     '{stem}-scaling.pdf',
+        'transition':  '{stem}-transition.pdf',
+        'breaking':    '{stem}-breaking.pdf',
+    }
+
+    def output(self, stage):
+        return self.stages[stage].format(stem=self.stem)
+
+    def __call__(self, stages):
+        for stage, output in self.stages.items():
+            if stage not in stages:
+                continue
+            if output and not self.stale(output := self.output(stage)):
+                logger.info(f'{output} is up to date; skipping {stage}.')
+                continue
+            with Timer(logger.info, f'{stage} {self.stem}'):
+                getattr(self, stage)()
+
+if __name__ == '__main__':
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('input_files', type=str, nargs='+')
+    parser.add_argument('--stages', type=str, nargs='+', choices=tuple(Campaign.stages.keys()), default=('produce', ))
+    parser.add_argument('--stem', type=str, nargs='*', default=(), help='Where to write each input file\'s figures; defaults to the input file without .py.')
+    parser.add_argument('--parallel', default=False, action='store_true')
+    parser.add_argument('--status', default='', type=str, help='In a --parallel computation, periodically write the progress of every row to this JSON file.')
+    parser.add_argument('--trace', default='', type=str, help='Record structured timing events to this file; see timeline.py.')
+    parser.add_argument('--catalog', default='', type=str, nargs='?', const=catalog.default, help=f'Record what is written in this SQLite catalog ({catalog.default} if no file is given); see catalog.py.')
+    parser.add_argument('--memory', default=None, type=float, help='In a --parallel computation, only run rows that fit in this many GiB at once; see parallel.py.')
+    parser.add_argument('--blas-threads', default=None, type=int, help='In a --parallel computation, BLAS threads per worker.')
+    parser.add_argument('--pin', default=None, action='store_true', help='In a --parallel computation, pin each worker to a core.')
+    parser.add_argument('--force', default=False, action='store_true', help='Remake figures even if they are up to date.')
+    parser.add_argument('--no-share', default=False, action='store_true', help='Do not keep data in memory between stages.')
+    parser.add_argument('--share', default=2., type=float, help='GiB of Ensembles and Bootstraps to keep in memory between stages.')
+
+    args = parser.parse_args()
+
+    if args.catalog:
+        catalog.use(args.catalog)
+
+    if args.parallel:
+        import parallel
+        parallel.configure(memory=args.memory, blas=args.blas_threads, pin=args.pin)
+
+    if args.stem and len(args.stem) != len(args.input_files):
+        parser.error('Give one --stem per input file.')
+    stems = args.stem or [f[:-3] if f.endswith('.py') else f for f in args.input_files]
+
+    if args.trace:
+        import timeline
+        timeline.start(args.trace)
+
+    if not args.parallel:
+        from tqdm.autonotebook import tqdm
+        steps.progress = tqdm
+        monitor = None
+    else:
+        from monitor import Monitor
+        monitor = Monitor(status=args.status)
+
+    for i, (f, stem) in enumerate(zip(args.input_files, stems)):
+        # Each input file gets a fresh memory; different campaigns rarely share data.
+        steps.memory = None if args.no_share else steps.Memory(limit=args.share * 2**30)
+
+        input_file = supervillain.cli.input_file(f'input{i}')(f)
+        Campaign(input_file, stem, parallel=args.parallel, monitor=monitor, force=args.force)(args.stages)
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+import os
+import json
+import sqlite3
+import hashlib
+from contextlib import contextmanager
+from time import time
+
+import pandas as pd
+import h5py as h5
+
+import supervillain
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Finding out what has been computed by opening every storage file and reading every step is slow,
+# and gets slower as a campaign spreads over more files (and every --parallel run adds a shard per row).
+# Instead, every h5_cached step records what it writes in one SQLite catalog:
+#
+#   step, path, file, input hash, W, N, κ, action, configurations, τ, bytes, seconds to compute, and when it was written.
+#
+# so that questions like 'which ensembles have fewer than 1000 configurations' are an indexed query.
+# SQLite handles concurrent writers (every worker of a --parallel run) itself.
+#
+# The catalog is off unless asked for, with SUPERVILLAIN_CATALOG or the --catalog argument of the scripts that write data.
+# Like the trace file, it is remembered in the environment so that worker processes inherit it.
+default = 'catalog.sqlite'
+file = os.environ.get('SUPERVILLAIN_CATALOG', '')
+
+def use(filename):
+    global file
+    file = filename
+    os.environ['SUPERVILLAIN_CATALOG'] = filename
+
+schema = '''
+CREATE TABLE IF NOT EXISTS entries (
+    step            TEXT NOT NULL,
+    path            TEXT NOT NULL,
+    file            TEXT NOT NULL,
+    input           TEXT,
+    W               INTEGER,
+    N               INTEGER,
+    kappa           REAL,
+    action          TEXT,
+    configurations  INTEGER,
+    tau             REAL,
+    bytes           INTEGER,
+    seconds         REAL,
+    written         REAL,
+    PRIMARY KEY (step, file, path)
+);
+CREATE INDEX IF NOT EXISTS parameters ON entries (W, N, kappa, action);
+CREATE INDEX IF NOT EXISTS paths ON entries (path);
+CREATE TABLE IF NOT EXISTS kept (
+    origin          TEXT NOT NULL,
+    path            TEXT NOT NULL,
+    W               INTEGER,
+    N               INTEGER,
+    kappa           REAL,
+    action          TEXT,
+    storage         TEXT NOT NULL,
+    file            TEXT NOT NULL,
+    written         REAL,
+    PRIMARY KEY (origin, path, storage, file)
+);
+'''
+
+@contextmanager
+def connection(filename=None):
+    c = sqlite3.connect(filename or file, timeout=60)
+    try:
+        c.execute('PRAGMA journal_mode=WAL')
+        c.executescript(schema)
+        with c:
+            yield c
+    finally:
+        c.close()
+
+def digest(row):
+    # A hash of everything about the row that describes the physics and the computation, but not where it is stored,
+    # nor where its warm or upscaled start is stored (which --parallel rewrites).
+    parameters = {k: v for k, v in row.items() if 'storage' not in k and k not in ('path', 'warm from', 'upscale from')}
+    return hashlib.sha1(json.dumps(parameters, sort_keys=True, default=str).encode()).hexdigest()
+
+def size(group):
+    # The bytes a group (or dataset) occupies on disk, not counting anything it links to in another file.
+    if isinstance(group, h5.Dataset):
+        return group.id.get_storage_size()
+
+    total = 0
+    def visit(name, obj):
+        nonlocal total
+        if isinstance(obj, h5.Dataset):
+            total += obj.id.get_storage_size()
+    group.visititems(visit)
+    return total
+
+def unpacked(group):
+    # The bytes a group (or dataset) occupies in memory once read, whatever the compression on disk.
+    if isinstance(group, h5.Dataset):
+        return group.size * group.dtype.itemsize
+
+    total = 0
+    def visit(name, obj):
+        nonlocal total
+        if isinstance(obj, h5.Dataset):
+            total += obj.size * obj.dtype.itemsize
+    group.visititems(visit)
+    return total
+
+def length(result):
+    # Only an ensemble has configurations; the length of anything else (like a GeneratorChoice's rates) is not one.
+    if isinstance(result, supervillain.Ensemble):
+        return len(result)
+    return None
+
+def record(step, row, f, path, result, nbytes=None, seconds=None):
+    r'''
+    Record that the step's result for the row was written to f/path.  Failing to record is not an error.
+    '''
+    if not file:
+        return
+
+    tau = getattr(result, 'tau', None)
+    try:
+        with connection() as c:
+            c.execute(
+                'INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (
+                    step, path, os.path.abspath(f), digest(row),
+                    int(row['W']) if 'W' in row else None,
+                    int(row['N']) if 'N' in row else None,
+                    float(row['kappa']) if 'kappa' in row else None,
+                    row.get('action', None),
+                    length(result),
+                    None if tau is None else float(tau),
+                    nbytes, seconds, time(),
+                ))
+    except Exception as e:
+        logger.warning(f'Could not record {step} {f}/{path} in the catalog {file}: {e}')
+
+def forget(step, f, path):
+    if not file:
+        return
+    try:
+        with connection() as c:
+            c.execute('DELETE FROM entries WHERE step=? AND file=? AND path=?', (step, os.path.abspath(f), path))
+    except Exception as e:
+        logger.warning(f'Could not remove {step} {f}/{path} from the catalog {file}: {e}')
+
+# Some scripts (such as adaptive.py) make rows of their own that no input file describes.
+# They record where those rows are stored, so that the garbage collector (reclaim.py) does not mistake their data for orphans.
+def keep(ensembles, origin):
+    if not file:
+        return
+    try:
+        with connection() as c:
+            c.executemany('INSERT OR REPLACE INTO kept VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [
+                (origin, row['path'], int(row['W']), int(row['N']), float(row['kappa']), row['action'], column, os.path.abspath(value), time())
+                for idx, row in ensembles.iterrows()
+                for column, value in row.items() if 'storage' in column
+                ])
+    except Exception as e:
+        logger.warning(f'Could not record the {origin} rows in the catalog {file}: {e}')
+
+def kept(filename=None):
+    r'''
+    A dataframe of the rows recorded with keep, with their parameters, path, and storage columns.
+    '''
+    index = ['origin', 'path', 'W', 'N', 'kappa', 'action']
+    with connection(filename) as c:
+        found = pd.read_sql_query(f'SELECT {", ".join(index)}, storage, file FROM kept', c)
+    if found.empty:
+        return pd.DataFrame(columns=index)
+    table = found.pivot_table(index=index, columns='storage', values='file', aggfunc='first').reset_index()
+    table.columns.name = None
+    return table
+
+def query(where='', parameters=(), filename=None):
+    r'''
+    A dataframe of the catalog entries that satisfy the SQL condition, for example
+
+    .. code:: python
+
+        catalog.query('step = ? AND configurations < ?', ('Ensemble', 1000))
+    '''
+    with connection(filename) as c:
+        return pd.read_sql_query(f'SELECT * FROM entries {"WHERE " + where if where else ""}', c, params=parameters)
+
+def lookup(ensembles, step, column, where='', parameters=(), filename=None):
+    r'''
+    For each row, the catalog entry of the step stored in the row's column (a storage) at the row's path
+    that also satisfies the SQL condition, if any, as a dataframe with the same index as the ensembles;
+    rows without such an entry get NaN.
+    '''
+    keys = pd.DataFrame({
+        'position': range(len(ensembles)),
+        'file': ensembles[column].map(os.path.abspath),
+        'path': ensembles['path'],
+        })
+
+    # A campaign can have more rows than SQLite allows parameters in one statement, so we join against a temporary table.
+    with connection(filename) as c:
+        c.execute('CREATE TEMP TABLE wanted (position INTEGER PRIMARY KEY, file TEXT, path TEXT)')
+        c.executemany('INSERT INTO wanted VALUES (?, ?, ?)', keys.itertuples(index=False, name=None))
+        found = pd.read_sql_query(
+            'SELECT wanted.position, entries.* FROM wanted JOIN entries '
+            'ON entries.file = wanted.file AND entries.path = wanted.path '
+            f'WHERE entries.step = ? {"AND (" + where + ")" if where else ""}',
+            c, params=(step, *parameters))
+        c.execute('DROP TABLE wanted')
+
+    # (step, file, path) is the primary key, so each row matches at most once.
+    entries = keys[['position']].merge(found.drop(columns=['file', 'path']), on='position', how='left')
+    entries = pd.concat([keys[['file', 'path']].reset_index(drop=True), entries.drop(columns='position')], axis=1)
+    entries.index = ensembles.index
+    return entries
+
+def rebuild(ensembles, cached):
+    r'''
+    Add catalog entries for data that were written before there was a catalog, by reading each of the cached steps of every row.
+    '''
+    from steps import Possible
+
+    for idx, row in ensembles.iterrows():
+        for step in cached:
+            f, path = step.target(row)
+            if (result := Possible(step).of(row)) is None:
+                continue
+            with h5.File(f, 'r') as h:
+                nbytes = size(h[path])
+            record(step.__name__, row, f, path, result, nbytes=nbytes)
+            logger.info(f'Cataloged {step.__name__} {f}/{path}')
+
+if __name__ == '__main__':
+
+    import steps
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('input_file', type=supervillain.cli.input_file('input'), default='input.py')
+    parser.add_argument('--catalog', default=file or default, type=str)
+    parser.add_argument('--parallel', default=False, action='store_true')
+    parser.add_argument('--rebuild', default=False, action='store_true', help='Catalog the data the input file describes that are already stored.')
+
+    args = parser.parse_args()
+    use(args.catalog)
+
+    ensembles = args.input_file.ensembles
+    if args.parallel:
+        from parallel import io_prep
+        ensembles = ensembles.apply(io_prep, axis=1)
+
+    if args.rebuild:
+        rebuild(ensembles, (steps.Thermalization, steps.Ensemble, steps.Bootstrap))
+
+    entries = pd.concat([
+        lookup(ensembles, 'Thermalization', 'thermalization storage'),
+        lookup(ensembles, 'Ensemble', 'ensemble storage'),
+        lookup(ensembles, 'Bootstrap', 'bootstrap storage'),
+        ]).dropna(subset=['step'])
+
+    with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 1000):
+        print(entries[['step', 'W', 'N', 'kappa', 'action', 'configurations', 'tau', 'bytes', 'seconds', 'file', 'path']])
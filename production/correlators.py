@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 from collections import deque
+from functools import lru_cache
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -18,6 +19,54 @@ _default_correlators=(
         #('Action_Action', r'$A(\Delta x)$'),
     )
 
+# Every row of a given N shares the same geometry, so we only work it out once per N.
+# The irrep projection is linear, so we can find which displacements feed into each projected
+# displacement (and with what weight) by projecting one-hot correlators, a chunk of displacements at a time.
+# Composing that with the linearization permutation gives a single gather that projects and linearizes
+# a whole stack of correlators at once.
+class Geometry:
+
+    def __init__(self, N):
+        L = supervillain.lattice.Lattice2D(N)
+        sites = N*N
+
+        # linearize is just a reshuffling of the spatial indices, which we can read off by linearizing the indices themselves.
+        permutation = L.linearize(np.arange(sites).reshape(N, N)).astype(int)
+
+        contributors = [deque() for _ in range(sites)]
+        for chunk in np.array_split(np.arange(sites), N):
+            one_hot = np.zeros((len(chunk), sites))
+            one_hot[np.arange(len(chunk)), chunk] = 1.
+            projected = L.irrep(one_hot.reshape(-1, N, N)).reshape(len(chunk), sites)
+            for source, target in zip(*np.nonzero(np.abs(projected) > 1e-12)):
+                contributors[target].append((chunk[source], projected[source, target]))
+
+        width = max(len(c) for c in contributors)
+        index  = np.zeros((sites, width), dtype=int)
+        weight = np.zeros((sites, width), dtype=projected.dtype)
+        for target, c in enumerate(contributors):
+            for j, (source, w) in enumerate(c):
+                index[target, j] = source
+                weight[target, j] = w
+
+        # We drop Δx=0, which cannot be shown on a log scale.
+        self.N = N
+        self.shells = L.linearize(L.R_squared**0.5)[1:]
+        self.index  = index[permutation][1:]
+        self.weight = weight[permutation][1:]
+
+    def project(self, correlators):
+        r'''
+        Project a stack of correlators with shape [..., N, N] to the A1 irrep and linearize,
+        giving an array of shape [..., len(self.shells)].
+        '''
+        flat = np.asarray(correlators).reshape(*np.shape(correlators)[:-2], self.N**2)
+        return np.einsum('...dj,dj->...d', flat[..., self.index], self.weight)
+
+@lru_cache
+def geometry(N):
+    return Geometry(N)
+
 def plot_correlators(ensembles,
                      correlators=_default_correlators,
                      ):
@@ -32,23 +81,27 @@ def plot_correlators(ensembles,
     ax = ax[0]
 
     e = len(ensembles)
+    # The ith row (in order of N) gets a small offset so that the different N are distinguishable.
+    ensembles = ensembles.sort_values(by=['N'], ascending=True).reset_index(drop=True)
 
-    for i, (idx, row) in enumerate(ensembles.sort_values(by=['N'], ascending=True).iterrows()):
-        L = supervillain.lattice.Lattice2D(row['N'])
-
-        dx = L.linearize(L.R_squared**0.5)[1:]
+    for N, rows in ensembles.groupby('N', sort=True):
+        G = geometry(N)
+        i = rows.index.to_numpy()
 
         # x-dependent offset for a log scale:
-        dx *= 1 + (i-e/2)/e / max(ensembles['N']) / 2
+        dx = G.shells * (1 + (i[:, None]-e/2)/e / max(ensembles['N']) / 2)
 
         for o, a in zip(correlators, ax):
-            a.errorbar(
-                    dx,
-                    L.linearize(L.irrep(row[o]))[1:].real, L.linearize(L.irrep(row[o+'±']))[1:].real,
-                    linestyle='none',
-                    label=f"N={row['N']}",
-                    marker=('o' if (row['W']==1 and o=='Vortex_Vortex') else 'none')
-                    )
+            mean  = G.project(np.stack(rows[o].to_numpy())).real
+            error = G.project(np.stack(rows[o+'±'].to_numpy())).real
+
+            for x, m, s, (idx, row) in zip(dx, mean, error, rows.iterrows()):
+                a.errorbar(
+                        x, m, s,
+                        linestyle='none',
+                        label=f"N={row['N']}",
+                        marker=('o' if (row['W']==1 and o=='Vortex_Vortex') else 'none')
+                        )
 
     ax[0].legend(loc='upper right')
 
@@ -4,6 +4,7 @@ import pandas as pd
 import supervillain
 from supervillain.performance import Timer
 from steps import Possible, Ensemble, Thermalization
+import catalog
 
 import logging
 logger = logging.getLogger(__name__)
@@ -31,6 +32,8 @@ if __name__ == '__main__':
     parser.add_argument('--cfgs-less-than', default=float('inf'), type=float)
     parser.add_argument('--cfgs-more-than', default=-1, type=float)
     parser.add_argument('--delete', default=False, action='store_true')
+    parser.add_argument('--catalog', default=None, type=str, nargs='?', const=catalog.file or catalog.default,
+                        help='Look the ensembles up in this catalog (by default the usual one) rather than reading every storage file.')
 
     args = parser.parse_args()
 
@@ -39,18 +42,35 @@ if __name__ == '__main__':
         from parallel import io_prep
         ensembles = ensembles.apply(io_prep, axis=1)
 
-    if args.W:
-        ensembles = ensembles[ensembles['W'] == args.W]
-    if args.N:
-        ensembles = ensembles[ensembles['N'] == args.N]
-    if args.kappa:
-        ensembles = ensembles[ensembles['kappa'] == args.kappa]
+    if args.catalog:
+        # The filters become one indexed query; no storage file is opened.
+        # Only rows whose Ensemble is in the catalog are shown.
+        conditions, parameters = ['configurations < ?', 'configurations > ?'], [args.cfgs_less_than, args.cfgs_more_than]
+        for column, value in (('W', args.W), ('N', args.N), ('kappa', args.kappa)):
+            if value:
+                conditions.append(f'{column} = ?')
+                parameters.append(value)
 
-    ensembles['length'] = ensembles.apply(length, axis=1)
-    ensembles['tau (t)']    = ensembles.apply(tau(Thermalization), axis=1)
-    ensembles['tau (e)']    = ensembles.apply(tau(Ensemble), axis=1)
+        produced   = catalog.lookup(ensembles, 'Ensemble', 'ensemble storage', ' AND '.join(conditions), parameters, filename=args.catalog)
+        ensembles  = ensembles[produced['step'].notna()].copy()
+        produced   = produced[produced['step'].notna()]
+        thermalized = catalog.lookup(ensembles, 'Thermalization', 'thermalization storage', filename=args.catalog)
+        ensembles['length'] = produced['configurations']
+        ensembles['tau (t)']    = thermalized['tau'].fillna(float('inf'))
+        ensembles['tau (e)']    = produced['tau'].fillna(float('inf'))
+    else:
+        if args.W:
+            ensembles = ensembles[ensembles['W'] == args.W]
+        if args.N:
+            ensembles = ensembles[ensembles['N'] == args.N]
+        if args.kappa:
+            ensembles = ensembles[ensembles['kappa'] == args.kappa]
 
-    ensembles = ensembles[(ensembles['length'] < args.cfgs_less_than) & (ensembles['length'] > args.cfgs_more_than)]
+        ensembles['length'] = ensembles.apply(length, axis=1)
+        ensembles['tau (t)']    = ensembles.apply(tau(Thermalization), axis=1)
+        ensembles['tau (e)']    = ensembles.apply(tau(Ensemble), axis=1)
+
+        ensembles = ensembles[(ensembles['length'] < args.cfgs_less_than) & (ensembles['length'] > args.cfgs_more_than)]
 
     ensembles = ensembles.sort_values(by=['W', 'kappa', 'N'], ascending=True)
 
@@ -62,8 +82,7 @@ if __name__ == '__main__':
         print(ensembles[['W', 'kappa', 'N', 'action', 'length', 'tau (t)', 'tau (e)']])
 
     if args.delete:
-        from pathlib import Path
-        
-        for idx, row in ensembles.iterrows():
-            Path(row['ensemble storage']).unlink()
-            Path(row['bootstrap storage']).unlink()
+        # Delete only the selected rows' ensembles and bootstraps, not the whole files, and reclaim the space.
+        import reclaim
+        report = reclaim.collect(ensembles, remove=('Ensemble', 'Bootstrap'))
+        print(f"Deleted {report['deleted'].sum()} ensembles and bootstraps; freed {report['freed'].sum()} bytes.")
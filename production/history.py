@@ -11,7 +11,72 @@ import steps
 import logging
 logger = logging.getLogger(__name__)
 
-def plot_history(ensemble):
+# A long thermalization history has millions of points per observable, far more than a panel can show,
+# and drawing them all makes a PDF that is enormous and slow to open.  Instead we draw at most a budget of points per panel:
+#
+#   - 'envelope' splits the history into bins and shades each bin from its minimum to its maximum, with its mean on top,
+#     so every excursion is still visible, or
+#   - 'lttb' keeps the points that preserve the shape of the line (largest-triangle-three-buckets; Steinarsson 2013).
+#
+# The histogram alongside is always made from every point.  A history shorter than the budget is drawn as usual,
+# by supervillain's Ensemble.plot_history, as is every history if the decimation is 'full'.
+decimations = ('envelope', 'lttb', 'full')
+
+def envelope(y, points):
+    r'''
+    The start, minimum, mean, and maximum of each of (at most) points bins of the history.
+    '''
+    bins = np.array_split(np.arange(len(y)), min(points, len(y)))
+    start = np.array([b[0] for b in bins])
+    return (
+        start,
+        np.array([y[b].min()  for b in bins]),
+        np.array([y[b].mean() for b in bins]),
+        np.array([y[b].max()  for b in bins]),
+        )
+
+def lttb(y, points):
+    r'''
+    The Monte Carlo times of (at most) points points that preserve the visual shape of the history.
+    '''
+    if points >= len(y) or points < 3:
+        return np.arange(len(y))
+
+    # The first and last points are always kept, and one point is chosen from each bucket in between,
+    # the one which makes the largest triangle with the previously-chosen point and the average of the next bucket.
+    edges = np.linspace(1, len(y)-1, points-1).astype(int)
+    chosen = [0]
+    for b in range(points-2):
+        here = np.arange(edges[b], edges[b+1])
+        following = np.arange(edges[b+1], edges[b+2]) if b+2 < len(edges) else np.array([len(y)-1])
+        tx, ty = following.mean(), y[following].mean()
+        px, py = chosen[-1], y[chosen[-1]]
+        area = np.abs((px - tx) * (y[here] - py) - (px - here) * (ty - py))
+        chosen.append(here[np.argmax(area)])
+    chosen.append(len(y)-1)
+    return np.array(chosen)
+
+def plot_decimated(axes, ensemble, observable, points=2000, decimation='envelope', bins=31):
+    y = np.real(getattr(ensemble, observable))
+    t = np.arange(len(y))
+
+    if decimation == 'full' or len(y) <= points:
+        ensemble.plot_history(axes, observable)
+        return
+
+    if decimation == 'envelope':
+        start, low, mean, high = envelope(y, points // 2)
+        axes[0].fill_between(start, low, high, step='post', color='gray', alpha=0.5, linewidth=0)
+        axes[0].plot(start, mean, color='black', linewidth=0.5, drawstyle='steps-post')
+    elif decimation == 'lttb':
+        kept = lttb(y, points)
+        axes[0].plot(t[kept], y[kept], color='black', linewidth=0.5)
+    else:
+        raise ValueError(f'Unknown decimation {decimation}; choose from {decimations}.')
+
+    axes[1].hist(y, bins=bins, orientation='horizontal', density=True, color='gray')
+
+def plot_history(ensemble, points=2000, decimation='envelope'):
 
     scalars = set(o for o, cls in supervillain.observables.items() if issubclass(cls, supervillain.observable.Scalar))
 
@@ -26,7 +91,7 @@ def plot_history(ensemble):
     fig.suptitle(f"W={S.W} κ={S.kappa:0.6f} N={S.Lattice.nx} {S.__class__.__name__}")
 
     for a, o in zip(ax, scalars):
-        ensemble.plot_history(a, o)
+        plot_decimated(a, ensemble, o, points=points, decimation=decimation)
         a[0].set_ylabel(o)
         
     ax[-1][0].set_xlabel('Monte Carlo Time')
@@ -35,16 +100,16 @@ def plot_history(ensemble):
 
     return fig, ax
 
-def visualize(ensembles):
+def visualize(ensembles, **kwargs):
     figs = deque()
     for E in ensembles:
-        fig, ax = plot_history(E)
+        fig, ax = plot_history(E, **kwargs)
         figs.append(fig)
     return figs
 
-def create_pdf(ensembles, PDF):
+def create_pdf(ensembles, PDF, **kwargs):
     for E in ensembles:
-        fig, ax = plot_history(E)
+        fig, ax = plot_history(E, **kwargs)
         PDF.save(fig)
         plt.close(fig)
 
@@ -57,6 +122,8 @@ if __name__ == '__main__':
     parser.add_argument('input_file', type=supervillain.cli.input_file('input'), default='input.py')
     parser.add_argument('--parallel', default=False, action='store_true')
     parser.add_argument('--pdf', default='', type=str)
+    parser.add_argument('--points', default=2000, type=int, help='The most points to draw per panel.')
+    parser.add_argument('--decimation', default='envelope', type=str, choices=decimations)
 
     args = parser.parse_args()
 
@@ -68,8 +135,8 @@ if __name__ == '__main__':
 
     if args.pdf:
         with results.PDF(args.pdf) as PDF:
-            create_pdf(results.ensembles(ensembles), PDF)
+            create_pdf(results.ensembles(ensembles), PDF, points=args.points, decimation=args.decimation)
     else:
-        figs = visualize(results.ensembles(ensembles))
+        figs = visualize(results.ensembles(ensembles), points=args.points, decimation=args.decimation)
         plt.show()
 
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import h5py as h5
+
+import supervillain
+from supervillain.performance import Timer
+from storage import store
+
+import logging
+logger = logging.getLogger(__name__)
+
+# E.measure() evaluates every observable supervillain knows on every configuration, including whole two-point correlators,
+# whether or not anyone will look at them.  Instead each step measures only a declared set of observables,
+#
+#   - the row's '{step} measure' column, if it has one,
+#   - otherwise its 'measure' column, and
+#   - otherwise the step's default,
+#
+# each of which may be a list of observable names, 'scalars' (every scalar observable), or 'all'.
+# Any other observable is still computed by supervillain, in memory, if something asks for it later.
+defaults = {
+    # The thermalization only needs τ, which comes from the scalars,
+    'thermalization': 'scalars',
+    # while the production ensemble feeds every analysis.
+    'ensemble': 'all',
+}
+
+def scalars():
+    return tuple(o for o, cls in supervillain.observables.items() if issubclass(cls, supervillain.observable.Scalar))
+
+def resolve(observables):
+    r'''
+    None for 'all', or the tuple of observable names.
+    '''
+    if observables is None or observables == 'all':
+        return None
+    if observables == 'scalars':
+        return scalars()
+    if isinstance(observables, str):
+        return (observables, )
+    return tuple(observables)
+
+def declared(row, step):
+    for column in (f'{step} measure', 'measure'):
+        value = row.get(column, None)
+        if isinstance(value, (str, list, tuple)):
+            return resolve(value)
+    return resolve(defaults[step])
+
+def measured(E, observable):
+    # supervillain keeps measurements on the ensemble itself.
+    return observable in vars(E)
+
+def measure(E, observables=None, workers=1):
+    r'''
+    Measure the observables (all of them if None) on every configuration of the ensemble,
+    splitting the configurations among the workers if there is more than one.
+    '''
+    if workers > 1 and len(E) >= 2 * workers:
+        return chunked(E, tuple(supervillain.observables) if observables is None else observables, workers)
+
+    if observables is None:
+        E.measure()
+        return E
+
+    for o in observables:
+        if not measured(E, o):
+            getattr(E, o)
+    return E
+
+# Every observable is measured configuration by configuration, so we can split the Monte Carlo history into chunks,
+# measure each chunk separately, and concatenate the results in order.  Each chunk is an ensemble whose configurations are
+# slices of the whole history, so nothing is copied, and we measure the chunks in threads, which share them;
+# the heavy lifting is in numpy, which releases the GIL.
+#
+# A row may ask for more than one worker with its 'measure workers' column, which is most useful
+# when there are fewer rows than cores, as in the last few rows of a --parallel campaign.
+def workers(row):
+    value = row.get('measure workers', 1)
+    if value == 'auto':
+        return os.cpu_count()
+    return 1 if value != value else int(value)
+
+def chunked(E, observables, workers):
+    missing = [o for o in observables if not measured(E, o)]
+    if not missing:
+        return E
+
+    edges = np.linspace(0, len(E), workers+1).astype(int)
+    chunks = [piece(E, a, b) for a, b in zip(edges[:-1], edges[1:])]
+
+    def work(chunk):
+        return {o: getattr(chunk, o) for o in missing}
+
+    with ThreadPoolExecutor(workers) as pool:
+        measurements = list(pool.map(work, chunks))
+
+    for o in missing:
+        vars(E)[o] = np.concatenate([m[o] for m in measurements])
+    return E
+
+def piece(E, a, b):
+    # An ensemble of configurations a through b of E, whose fields are slices of (so share memory with) E's.
+    P = supervillain.Ensemble(E.Action)
+    P.configuration = E.configuration[a:b]
+    return P
+
+# An observable that was not measured when the ensemble was generated (because it was not declared, or did not exist yet)
+# is still measured by supervillain the first time it is asked for, but only in memory.  Where it matters (the Bootstrap step,
+# and results.collect) we instead ensure the observables explicitly: measure whatever is missing and store it next to the
+# configurations, so that nobody has to measure it again.
+#
+# The ensemble's file may still be open for reading (results.prefetch reads ahead from the same files), and HDF5 will not
+# also open it for writing; so a caller that is still reading can pass a list of pending writes and flush it when it is done.
+def ensure(E, observables, location, workers=1, pending=None):
+    r'''
+    Measure those of the observables the ensemble lacks and store them at location, (file, path, storage policy),
+    or append the writes to pending, if it is given, to be written by flush.
+    '''
+    missing = [o for o in observables if o in supervillain.observables and not measured(E, o)]
+    if not missing:
+        return E
+
+    measure(E, missing, workers)
+    values = {o: vars(E)[o] for o in missing}
+    if pending is None:
+        persist(location, values)
+    else:
+        pending.append((location, values))
+    return E
+
+def flush(pending):
+    # Write every pending measurement, opening each file once.
+    files = dict()
+    for (f, path, storage), values in pending:
+        files.setdefault(f, deque()).append((path, storage, values))
+    for f, writes in files.items():
+        try:
+            with h5.File(f, 'a') as file:
+                for path, storage, values in writes:
+                    write(file, f, path, storage, values)
+        except Exception as e:
+            logger.warning(f'Could not store measurements in {f}: {e}')
+    pending.clear()
+
+def persist(location, values):
+    f, path, storage = location
+    try:
+        with h5.File(f, 'a') as file:
+            write(file, f, path, storage, values)
+    except Exception as e:
+        logger.warning(f'Could not store {", ".join(values)} in {f}/{path}: {e}')
+
+def write(file, f, path, storage, values):
+    for name, value in values.items():
+        if name in file[path]:
+            continue
+        store(file, f'{path}/{name}', value, storage)
+        logger.info(f'Stored {name} in {f}/{path}')
+
+# A Bootstrap's observables are measured on the ensemble it holds.
+inside = {
+    'Bootstrap': 'Ensemble',
+}
+
+def observe(step, row, observables):
+    r'''
+    Make sure the observables are measured on the row's stored result of the step, and stored with it.
+    '''
+    f, path = step.target(row)
+    result = step.of(row)
+    if (attribute := inside.get(step.__name__)):
+        ensure(getattr(result, attribute), observables, (f, f'{path}/{attribute}', None), workers(row))
+    else:
+        ensure(result, observables, (f, path, step.storage), workers(row))
+    return result
+
+if __name__ == '__main__':
+
+    import steps
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('input_file', type=supervillain.cli.input_file('input'), default='input.py')
+    parser.add_argument('--parallel', default=False, action='store_true')
+    parser.add_argument('--step', default='Ensemble', choices=('Thermalization', 'Ensemble', 'Bootstrap'))
+    parser.add_argument('observables', type=str, nargs='+', help='Measure these observables on every stored ensemble that lacks them.')
+
+    args = parser.parse_args()
+
+    ensembles = args.input_file.ensembles
+    if args.parallel:
+        from parallel import io_prep
+        ensembles = ensembles.apply(io_prep, axis=1)
+
+    step = getattr(steps, args.step)
+    for idx, row in ensembles.iterrows():
+        if steps.Possible(step).of(row) is None:
+            continue
+        with Timer(logger.info, f"Measuring {', '.join(args.observables)} on {row['path']}"):
+            observe(step, row, args.observables)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+
+import os
+import json
+from collections import deque
+from contextlib import contextmanager
+from threading import Thread
+from time import time, monotonic
+from multiprocessing import Manager
+
+import steps
+
+import logging
+logger = logging.getLogger(__name__)
+
+# In a --parallel run each worker has its own copy of steps.progress, and there is nobody to show a progress bar to.
+# Instead, each worker reports its progress over a queue to a Monitor in the parent process,
+# which shows one bar per running row, the number of rows done and remaining, and an ETA,
+# and can also write the same information to a JSON status file that can be polled.
+#
+# The workers' half is a Reporter, which is a drop-in replacement for steps.progress,
+
+class Reporter:
+
+    def __init__(self, queue, path, interval=0.5):
+        self.queue = queue
+        self.path = path
+        self.interval = interval
+        self.stage = 0
+
+    def report(self, **kwargs):
+        self.queue.put({'path': self.path, 'pid': os.getpid(), 'time': time()} | kwargs)
+
+    def __call__(self, iterable, total=None, desc=None, **kwargs):
+        if total is None:
+            try:
+                total = len(iterable)
+            except TypeError:
+                pass
+
+        # Each row may have more than one loop; thermalization and production, for example.
+        self.stage += 1
+        self.report(event='stage', stage=self.stage, desc=desc, total=total)
+
+        last = monotonic()
+        n = 0
+        for n, item in enumerate(iterable, 1):
+            yield item
+            if (now := monotonic()) - last > self.interval:
+                self.report(event='progress', stage=self.stage, n=n, total=total)
+                last = now
+        self.report(event='progress', stage=self.stage, n=n, total=total)
+
+# and each task (usually one row) is run as a Task which installs a Reporter before doing the work.
+# Pool.map needs to pickle the Task, which is why the queue comes from a Manager.
+def label(ensembles):
+    path = ensembles['path'].iloc[0]
+    if len(ensembles) > 1:
+        path += f' (+{len(ensembles)-1})'
+    return path
+
+class Task:
+
+    def __init__(self, f, queue):
+        self.f = f
+        self.queue = queue
+
+    def __call__(self, ensembles):
+        path = label(ensembles)
+        reporter = Reporter(self.queue, path)
+        steps.progress = reporter
+
+        reporter.report(event='start')
+        try:
+            return self.f(ensembles)
+        finally:
+            reporter.report(event='done')
+
+class Monitor:
+
+    def __init__(self, status='', interval=2.):
+        self.status = status
+        self.interval = interval
+
+    @contextmanager
+    def watching(self, paths, workers):
+        r'''
+        A context in which workers running tasks with the given labels may report to the yielded queue.
+        '''
+        self.workers = workers
+        self.rows = {p: {'state': 'pending'} for p in paths}
+        self.bars = dict()
+        self.positions = dict()
+        self.started = time()
+        self.finished = deque()
+
+        from tqdm.autonotebook import tqdm
+        self.tqdm = tqdm
+        self.overall = tqdm(total=len(self.rows), desc='rows', position=0, unit='row')
+
+        with Manager() as manager:
+            queue = manager.Queue()
+            listener = Thread(target=self._listen, args=(queue,), daemon=True)
+            listener.start()
+            try:
+                yield queue
+            finally:
+                queue.put(None)
+                listener.join()
+                self._write()
+                for bar in self.bars.values():
+                    bar.close()
+                self.overall.close()
+
+    def _listen(self, queue):
+        written = 0
+        while (message := queue.get()) is not None:
+            try:
+                self._update(message)
+            except Exception as e:
+                logger.warning(f'Could not understand progress report {message}: {e}')
+
+            if self.status and monotonic() - written > self.interval:
+                self._write()
+                written = monotonic()
+
+    def _update(self, message):
+        path = message['path']
+        row  = self.rows.setdefault(path, {'state': 'pending'})
+        event = message['event']
+
+        if event == 'start':
+            row.update(state='running', pid=message['pid'], started=message['time'])
+            # Put the bar in the first free line under the overall bar.
+            # We track the lines ourselves; tqdm stores an explicit position negated in bar.pos.
+            taken = set(self.positions.values())
+            position = min(p for p in range(1, len(taken)+2) if p not in taken)
+            self.positions[path] = position
+            self.bars[path] = self.tqdm(desc=path, position=position, leave=False)
+
+        elif event == 'stage':
+            row.update(stage=message['stage'], desc=message['desc'], n=0, total=message['total'], stage_started=message['time'])
+            if bar := self.bars.get(path):
+                bar.reset(total=message['total'])
+                bar.set_description(f"{path} [{message['desc'] or message['stage']}]")
+
+        elif event == 'progress':
+            elapsed = message['time'] - row.get('stage_started', message['time'])
+            row.update(n=message['n'], total=message['total'], rate=(message['n'] / elapsed if elapsed > 0 else None))
+            if bar := self.bars.get(path):
+                bar.update(message['n'] - bar.n)
+
+        elif event == 'done':
+            row.update(state='done', finished=message['time'])
+            self.finished.append(message['time'] - row.get('started', message['time']))
+            if bar := self.bars.pop(path, None):
+                bar.close()
+            self.positions.pop(path, None)
+            self.overall.update(1)
+
+        self.overall.set_postfix(running=self._count('running'), remaining=self._count('pending'), eta=self._eta_string())
+
+    def _count(self, state):
+        return sum(1 for r in self.rows.values() if r['state'] == state)
+
+    def eta(self):
+        r'''
+        A rough estimate of the seconds remaining.
+
+        Running rows finish their current loop at its measured rate; pending rows are assumed to take as long as the rows that have finished,
+        and all of that work is shared among the workers.
+        '''
+        running = [r for r in self.rows.values() if r['state'] == 'running']
+        remaining = [
+            (r['total'] - r['n']) / r['rate'] if r.get('rate') and r.get('total') else 0.
+            for r in running
+            ]
+
+        pending = self._count('pending')
+        if pending and not self.finished:
+            return None
+        typical = sum(self.finished) / len(self.finished) if self.finished else 0.
+
+        return max(max(remaining, default=0.), (sum(remaining) + pending * typical) / self.workers)
+
+    def _eta_string(self):
+        if (eta := self.eta()) is None:
+            return '?'
+        minutes, seconds = divmod(int(eta), 60)
+        hours, minutes = divmod(minutes, 60)
+        return f'{hours}:{minutes:02d}:{seconds:02d}'
+
+    def _write(self):
+        if not self.status:
+            return
+
+        status = {
+            'updated': time(),
+            'elapsed': time() - self.started,
+            'workers': self.workers,
+            'done': self._count('done'),
+            'running': self._count('running'),
+            'pending': self._count('pending'),
+            'eta': self.eta(),
+            'rows': self.rows,
+        }
+
+        # Write and then move so that a poller never sees a half-written file.
+        temporary = f'{self.status}.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(status, f, indent=2, default=str)
+        os.replace(temporary, self.status)
@@ -1,5 +1,10 @@
 #!/usr/bin/env python3
 
+import os
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition
+
 import h5py as h5
 import pandas as pd
 import supervillain
@@ -7,11 +12,15 @@ from production import produce
 
 import steps
 from steps import progress
+from monitor import label
+
+import logging
+logger = logging.getLogger(__name__)
 
 # If we have a very big computational task ahead of us we may benefit from distributing an ensemble
 # to each available core, which is a conceptually simple and straightforward division of labor.
 # Therefore, we use the multiprocessing library
-from multiprocessing import Pool, cpu_count
+from multiprocessing import Pool, Value, cpu_count
 
 # The primary danger is in i/o.  The issue is that if more than one worker tries to open the same HDF5 file
 # there might an an exception or file corruption.  Therefore we will need to let each worker write its own file
@@ -32,11 +41,117 @@ def io_prep(row):
 
     return row
 
+# Besides the result at each row's path, a storage may hold results of other steps at paths of their own.
+also = {
+    'thermalization storage': (steps.GeneratorChoice, ),
+}
+
+def gathered(row, key):
+    return [step.target(row)[1] for step in also.get(key, ())]
+
+# Starting one worker per core is fine for small lattices, but a handful of N=64 rows running at once can exhaust memory,
+# and if each worker's BLAS starts a thread per core too the cores are badly oversubscribed.
+# So we estimate how much memory each task needs and only start a task when it fits into a budget alongside the running ones
+# (a task that does not fit even on its own runs alone), limit each worker's BLAS and OpenMP threads,
+# and can optionally pin each worker to its own core.
+#
+# The defaults come from the environment, so that they can be set once for a whole campaign:
+#
+#   SUPERVILLAIN_MEMORY         the budget in GiB (default: 80% of physical memory),
+#   SUPERVILLAIN_BLAS_THREADS   threads per worker (default: 1), and
+#   SUPERVILLAIN_PIN            pin workers to cores if set to anything but 0 or the empty string.
+#
+# or with configure (as the --memory, --blas-threads, and --pin arguments of production.py, thermalize.py, and campaign.py do).
+def physical_memory():
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+def configure(memory=None, blas=None, pin=None):
+    if memory is not None:
+        os.environ['SUPERVILLAIN_MEMORY'] = str(memory)
+    if blas is not None:
+        os.environ['SUPERVILLAIN_BLAS_THREADS'] = str(blas)
+    if pin is not None:
+        os.environ['SUPERVILLAIN_PIN'] = '1' if pin else ''
+
+def budget():
+    if (memory := os.environ.get('SUPERVILLAIN_MEMORY', '')):
+        return float(memory) * 2**30
+    if (physical := physical_memory()) is None:
+        return float('inf')
+    return 0.8 * physical
+
+def blas_threads():
+    return int(os.environ.get('SUPERVILLAIN_BLAS_THREADS', 1))
+
+def pinned():
+    return os.environ.get('SUPERVILLAIN_PIN', '') not in ('', '0')
+
+# A row's memory is dominated by the stored history of its configurations and their measurements.
+# Every field is a handful of numbers per site, and the two-point correlators are a few more complex numbers per site,
+# so we estimate
+#
+#   bytes ≈ (configurations in memory at once) × N² × bytes per site
+#
+# where a thermalization holds its whole history and production holds its configurations.
+# A row may instead give its own estimate, in GiB, in a 'memory' column.
+bytes_per_site = 8 * 4 + 16 * 4
+
+def memory(row):
+    if 'memory' in row and row['memory'] == row['memory']:
+        return float(row['memory']) * 2**30
+    history = max(int(v) for v in (row.get('thermalize', 0), row.get('configurations', 0), 0) if v == v)
+    return history * int(row['N'])**2 * bytes_per_site
+
+blas_variables = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+# Workers started by spawn read these before they import numpy, so they must be in the environment the pool starts with;
+# but only while it starts, so that the parent's own BLAS (and anything else it runs later) is not limited.
+@contextmanager
+def blas_environment(threads):
+    previous = {v: os.environ.get(v, None) for v in blas_variables}
+    for v in blas_variables:
+        os.environ[v] = str(threads)
+    try:
+        yield
+    finally:
+        for v, value in previous.items():
+            if value is None:
+                os.environ.pop(v, None)
+            else:
+                os.environ[v] = value
+
+def worker(threads, pin, counter):
+    # Runs in each worker as it starts.
+    for v in blas_variables:
+        os.environ[v] = str(threads)
+
+    # numpy may already have started its BLAS (in a forked worker it was imported by the parent);
+    # threadpoolctl can still limit it, if it is installed.
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(threads)
+    except ImportError:
+        pass
+
+    if pin and hasattr(os, 'sched_setaffinity'):
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+        cores = sorted(os.sched_getaffinity(0))
+        core = cores[index % len(cores)]
+        os.sched_setaffinity(0, {core})
+
 # Finally we are ready to set up some work.
 # Parallelize takes
 #
-#  - a function f that loops over a dataframe of ensembles and
-#  - a number of threads, which defaults to the multiprocessing cpu_count
+#  - a function f that loops over a dataframe of ensembles,
+#  - a number of threads, which defaults to the multiprocessing cpu_count, and
+#  - optionally a monitor.Monitor, which shows the progress the workers report, and
+#  - optionally columns by which to group ensembles into tasks, so that a group is computed in order by one worker,
+#  - optionally a memory budget in bytes, BLAS threads per worker, and whether to pin workers, which default as described above,
 #
 # and is callable on
 #
@@ -45,9 +160,14 @@ def io_prep(row):
 #
 class Parallelize:
 
-    def __init__(self, f, threads=cpu_count()):
+    def __init__(self, f, threads=cpu_count(), monitor=None, by=None, memory=None, blas=None, pin=None):
         self.f = f
         self.threads = threads
+        self.monitor = monitor
+        self.by = by
+        self.memory = budget() if memory is None else memory
+        self.blas = blas_threads() if blas is None else blas
+        self.pin = pinned() if pin is None else pin
 
     def _gather(self, row, key):
         start = key
@@ -56,21 +176,75 @@ class Parallelize:
             with h5.File(row[target], mode='a') as h5fw:
                 print(f"Linking {row[start]}/{row['path']} into {row[target]}")
                 h5fw[row['path']] = h5.ExternalLink(row[start], row['path'])
+
+                # Other results stored in the same shard, such as the generator an 'auto' row chose, are linked too if they exist.
+                with h5.File(row[start], mode='r') as h5fr:
+                    for path in gathered(row, key):
+                        if path in h5fr and path not in h5fw:
+                            print(f"Linking {row[start]}/{path} into {row[target]}")
+                            h5fw[path] = h5.ExternalLink(row[start], path)
         except Exception as e:
             print('GATHER:', e)
 
+    def _admit(self, pool, f, tasks):
+        # Start tasks in order, but skip ahead to smaller ones while a big one does not fit.
+        # The rows of a task are computed one after another and nothing is remembered between them (steps.memory is None),
+        # so a task needs as much memory as its biggest row.
+        estimates = [max(memory(row) for idx, row in t.iterrows()) for t in tasks]
+        pending = deque(range(len(tasks)))
+        running = dict()
+        condition = Condition()
+
+        def finished(i):
+            def callback(result):
+                with condition:
+                    running.pop(i)
+                    condition.notify_all()
+            return callback
+
+        def failed(i):
+            def callback(exception):
+                print(exception)
+                finished(i)(None)
+            return callback
+
+        with condition:
+            while pending:
+                used = sum(running.values())
+                fits = [i for i in pending if len(running) < self.threads and (not running or used + estimates[i] <= self.memory)]
+                if not fits:
+                    condition.wait()
+                    continue
+                i = fits[0]
+                pending.remove(i)
+                running[i] = estimates[i]
+                if estimates[i] > self.memory:
+                    logger.warning(f'{label(tasks[i])} needs about {estimates[i]/2**30:.1f} GiB, more than the budget of {self.memory/2**30:.1f} GiB; running it alone.')
+                pool.apply_async(f, (tasks[i], ), callback=finished(i), error_callback=failed(i))
+
+            condition.wait_for(lambda: not running)
 
     def __call__(self, ensembles, gather=()):
 
         rewritten = ensembles.apply(io_prep, axis=1)
-
-        with Pool(self.threads) as p:
+        if self.by:
+            tasks = [group for key, group in rewritten.groupby(self.by)]
+        else:
+            tasks = [row.to_frame().T for idx, row in rewritten.iterrows()]
+
+        counter = Value('i', 0)
+        with blas_environment(self.blas):
+            pool = Pool(self.threads, initializer=worker, initargs=(self.blas, self.pin, counter))
+        with pool as p:
             try:
-                p.map(self.f, (row.to_frame().T for idx, row in rewritten.iterrows()))
+                if self.monitor:
+                    from monitor import Task
+                    with self.monitor.watching([label(t) for t in tasks], self.threads) as queue:
+                        self._admit(p, Task(self.f, queue), tasks)
+                else:
+                    self._admit(p, self.f, tasks)
             except Exception as e:
                 print(e)
 
         for g in gather:
             rewritten.apply(lambda row: self._gather(row, g), axis=1)
-
-
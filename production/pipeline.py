@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+from pathlib import Path
+from time import perf_counter, sleep
+
+import pandas as pd
+
+import supervillain
+from benchmark import machine
+import timeline
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The demo is the closest thing we have to an end-to-end performance test; the Makefile says it 'takes about 11 minutes'.
+# This benchmark runs every demo input through every stage, from scratch, in a fresh directory,
+# and records for each stage
+#
+#   - wall and cpu time (including any worker processes),
+#   - peak resident memory of the whole process tree (the stage and all its workers at once),
+#     and of the largest single process,
+#   - bytes the process tree read and wrote (through the page cache or not), and, separately,
+#     the bytes that actually reached the disk, which are near 0 for reads on a warm cache, and
+#   - how much the stage grew the storage files,
+#
+# plus, from a timeline trace, how the time divides among the steps (Thermalization, Ensemble, Bootstrap, ...).
+# Each stage runs in its own campaign.py process so that its resources can be measured separately,
+# in serial and (optionally) --parallel mode.  Every run is appended as one JSON line to a history file,
+# and compared against the previous run of the same mode on the same host.
+
+here = Path(__file__).resolve().parent
+
+# Like the Makefile's demo targets, but with thermalization as a stage of its own.
+# The produce stage also makes the bootstraps, and each plotting stage collects the bootstrapped observables it needs.
+demos = {
+    'scaling':    ('thermalize', 'produce', 'history', 'correlators', 'scaling'),
+    'transition': ('thermalize', 'produce', 'history', 'transition'),
+    'breaking':   ('thermalize', 'produce', 'breaking'),
+}
+
+def storage_bytes(directory):
+    return sum(f.stat().st_size for f in Path(directory).rglob('*.h5'))
+
+# wait4 reports the largest single process's peak memory (not the sum over parallel workers) and only the I/O that reached the disk.
+# So while the stage runs we also sample, for every process in its tree, the resident memory and the bytes read and written
+# (rchar and wchar in /proc/<pid>/io, which count reads served from the page cache too).  What a process does in the
+# interval before it exits is missed, so the tree's I/O is an underestimate, by the most for short stages.
+# Without /proc (as on macOS) those measurements are None.
+def tree(root):
+    # The pids of root and all its descendants.
+    parents = dict()
+    for stat in Path('/proc').glob('[0-9]*/stat'):
+        try:
+            # The command may contain spaces and parentheses; the parent pid is the second field after the last ')'.
+            parents[int(stat.parent.name)] = int(stat.read_text().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+
+    found, frontier = {root}, [root]
+    while frontier:
+        pid = frontier.pop()
+        children = [child for child, parent in parents.items() if parent == pid and child not in found]
+        found.update(children)
+        frontier.extend(children)
+    return found
+
+def sample(pid):
+    # (resident bytes, bytes read, bytes written) of one process, or None if it is gone.
+    try:
+        rss = next(int(line.split()[1]) * 1024 for line in Path(f'/proc/{pid}/status').read_text().splitlines() if line.startswith('VmRSS:'))
+        io = dict(line.split(': ') for line in Path(f'/proc/{pid}/io').read_text().splitlines())
+        return rss, int(io['rchar']), int(io['wchar'])
+    except (OSError, StopIteration, KeyError, ValueError):
+        return None
+
+def run(command, cwd, env, interval=0.2):
+    r'''
+    Run the command to completion, returning its wall time and its (and its children's) resource usage.
+    '''
+    proc = Path('/proc').is_dir()
+    peak = 0
+    io = dict()  # pid: (read, written), the latest sample of each process
+
+    start = perf_counter()
+    process = subprocess.Popen(command, cwd=cwd, env=env)
+    while True:
+        # Unlike getrusage(RUSAGE_CHILDREN), wait4 gives the usage of just this process and the children it waited for.
+        pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+        if pid:
+            break
+        if proc:
+            samples = {p: s for p in tree(process.pid) if (s := sample(p)) is not None}
+            peak = max(peak, sum(s[0] for s in samples.values()))
+            io.update({p: s[1:] for p, s in samples.items()})
+        sleep(interval)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    wall = perf_counter() - start
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command)
+
+    return {
+        'wall': wall,
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'peak rss': peak if proc else None,
+        # ru_maxrss is in KiB on Linux (but bytes on macOS).
+        'largest process rss': usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024),
+        'read': sum(r for r, w in io.values()) if proc else None,
+        'written': sum(w for r, w in io.values()) if proc else None,
+        # Block counts are in 512-byte units and only count I/O that reached the disk, not the page cache.
+        'disk read': usage.ru_inblock * 512,
+        'disk written': usage.ru_oublock * 512,
+    }
+
+def pipeline(mode, demos=demos, scratch=None):
+    r'''
+    Runs every demo through its stages in a fresh scratch directory, returning one result per (demo, stage).
+    '''
+    results = []
+    with tempfile.TemporaryDirectory(dir=scratch) as directory:
+        (Path(directory) / 'demo').mkdir()
+        env = os.environ | {
+            'PYTHONPATH': os.pathsep.join(filter(None, (str(here), os.environ.get('PYTHONPATH', '')))),
+            'SUPERVILLAIN_CATALOG': str(Path(directory) / 'catalog.sqlite'),
+        }
+
+        for demo, stages in demos.items():
+            for stage in stages:
+                trace = Path(directory) / f'{demo}-{stage}.trace'
+                command = [
+                    sys.executable, str(here / 'campaign.py'), str(here / 'demo' / f'{demo}.py'),
+                    '--stem', f'demo/{demo}', '--stages', stage, '--force', '--trace', str(trace),
+                    ] + (['--parallel'] if mode == 'parallel' else [])
+
+                before = storage_bytes(directory)
+                logger.info(f'{mode} {demo} {stage}')
+                result = {'mode': mode, 'demo': demo, 'stage': stage} | run(command, directory, env)
+                result['storage'] = storage_bytes(directory) - before
+
+                if trace.exists():
+                    steps = timeline.summary(timeline.read(trace)).reset_index()
+                    result['steps'] = {f"{r['step']} {r['phase']}": r['self'] for idx, r in steps.iterrows()}
+
+                logger.info(result)
+                results.append(result)
+
+    return results
+
+# Each result is identified by
+key = ['mode', 'demo', 'stage']
+# and we watch
+watched = ['wall', 'cpu', 'peak rss']
+
+def compare(results, baseline, tolerance=0.2):
+    r'''
+    Joins the results with the baseline, giving the ratio of each watched quantity to the baseline and
+    marking as a regression any that has grown by more than the tolerance.
+    '''
+    current = pd.DataFrame(results).set_index(key)
+    old = pd.DataFrame(baseline).set_index(key)
+    # Runs from before the whole process tree was sampled recorded the largest process's peak as the 'peak rss',
+    # and without /proc there is no tree to sample; only compare what both runs measured the same way.
+    if 'largest process rss' not in old.columns:
+        old = old.drop(columns=['peak rss'], errors='ignore')
+    compared = [w for w in watched if w in current.columns and w in old.columns and current[w].notna().all() and old[w].notna().all()]
+
+    comparison = current[compared].join(old[compared], rsuffix=' (baseline)', how='inner')
+    for w in compared:
+        comparison[f'{w} ratio'] = comparison[w] / comparison[f'{w} (baseline)']
+    comparison['regression'] = (comparison[[f'{w} ratio' for w in compared]] > 1 + tolerance).any(axis=1)
+    return comparison
+
+def history(filename):
+    try:
+        with open(filename) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    except FileNotFoundError:
+        return []
+
+def previous(runs, host, modes):
+    # The most recent run on the same host that measured the same modes.
+    for r in reversed(runs):
+        if r['machine']['host'] == host and set(r['modes']) == set(modes):
+            return r
+    return None
+
+if __name__ == '__main__':
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('--modes', default=('serial', 'parallel'), type=str, nargs='+', choices=('serial', 'parallel'))
+    parser.add_argument('--demos', default=tuple(demos), type=str, nargs='+', choices=tuple(demos))
+    parser.add_argument('--history', default='pipeline-history.jsonl', type=str, help='Append the results to this file, one run per line.')
+    parser.add_argument('--scratch', default=None, type=str, help='Where to make the scratch directories; defaults to the system temporary directory.')
+    parser.add_argument('--tolerance', default=0.2, type=float, help='Fractional growth relative to the previous run that counts as a regression.')
+
+    args = parser.parse_args()
+
+    results = []
+    for mode in args.modes:
+        results += pipeline(mode, demos={d: demos[d] for d in args.demos}, scratch=args.scratch)
+
+    table = pd.DataFrame(results).set_index(key)[['wall', 'cpu', 'peak rss', 'largest process rss', 'read', 'written', 'disk read', 'disk written', 'storage']]
+    with pd.option_context('display.max_rows', None, 'display.width', 1000, 'display.float_format', '{:.2f}'.format):
+        print(table)
+        print(table.groupby('mode').sum()[['wall', 'cpu']])
+
+    this = {'machine': machine(), 'modes': list(args.modes), 'results': results}
+    baseline = previous(history(args.history), this['machine']['host'], args.modes)
+
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(this, default=float) + '\n')
+
+    if baseline is not None:
+        comparison = compare(results, baseline['results'], tolerance=args.tolerance)
+        print(f"Compared against the run from {baseline['machine']['time']} (supervillain {baseline['machine']['supervillain']})")
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', 1000):
+            print(comparison)
+
+        if comparison['regression'].any():
+            logger.error(f"{comparison['regression'].sum()} of {len(comparison)} stages regressed by more than {args.tolerance:.0%}.")
+            sys.exit(1)
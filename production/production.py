@@ -2,6 +2,9 @@
 
 import supervillain
 from supervillain.performance import Timer
+import timeline
+import catalog
+import schedule
 from steps import Bootstrap
 
 import logging
@@ -10,12 +13,12 @@ logger = logging.getLogger(__name__)
 def produce(ensembles):
 
     with Timer(logger.info, f'Producing {len(ensembles)} bootstraps'):
-        for idx, row in ensembles.sort_values(by=['W', 'N', 'kappa'], ascending=True).iterrows():
+        for idx, row in schedule.order(ensembles).iterrows():
 
             for line in str(row).split('\n'):
                 logger.info(line)
 
-            with Timer(logger.info, f'Producing bootstrap for W={row["W"]} N={row["N"]} κ={row["kappa"]:0.6f}'):
+            with timeline.timed(logger.info, f'Producing bootstrap for W={row["W"]} N={row["N"]} κ={row["kappa"]:0.6f}', 'Bootstrap', 'produce', row):
                 B = Bootstrap.of(row)
 
 if __name__ == '__main__':
@@ -23,10 +26,26 @@ if __name__ == '__main__':
     parser = supervillain.cli.ArgumentParser()
     parser.add_argument('input_file', type=supervillain.cli.input_file('input'), default='input.py')
     parser.add_argument('--parallel', default=False, action='store_true')
+    parser.add_argument('--trace', default='', type=str, help='Record structured timing events to this file; see timeline.py.')
+    parser.add_argument('--catalog', default='', type=str, nargs='?', const=catalog.default, help=f'Record what is written in this SQLite catalog ({catalog.default} if no file is given); see catalog.py.')
+    parser.add_argument('--status', default='', type=str, help='In a --parallel computation, periodically write the progress of every row to this JSON file.')
+    parser.add_argument('--memory', default=None, type=float, help='In a --parallel computation, only run rows that fit in this many GiB at once; see parallel.py.')
+    parser.add_argument('--blas-threads', default=None, type=int, help='In a --parallel computation, BLAS threads per worker.')
+    parser.add_argument('--pin', default=None, action='store_true', help='In a --parallel computation, pin each worker to a core.')
     parser.add_argument('--parallel-files', default=False, action='store_true', help='Store not in the usual storage spots but instead where it would be stored in a --parallel computation.  Useful for testing / debugging.')
 
     args = parser.parse_args()
 
+    if args.catalog:
+        catalog.use(args.catalog)
+
+    if args.parallel:
+        import parallel
+        parallel.configure(memory=args.memory, blas=args.blas_threads, pin=args.pin)
+
+    if args.trace:
+        timeline.start(args.trace)
+
     if not args.parallel:
         if args.parallel_files:
             from parallel import io_prep
@@ -41,4 +60,5 @@ if __name__ == '__main__':
             produce(args.input_file.ensembles)
     else:
         from parallel import Parallelize
-        Parallelize(produce)(args.input_file.ensembles, gather=('ensemble storage', 'bootstrap storage', ))
+        from monitor import Monitor
+        Parallelize(produce, monitor=Monitor(status=args.status), by=schedule.families(args.input_file.ensembles))(args.input_file.ensembles, gather=('ensemble storage', 'bootstrap storage', ))
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+
+import os
+from collections import deque
+from pathlib import Path
+
+import h5py as h5
+import pandas as pd
+
+import supervillain
+from supervillain.performance import Timer
+import steps
+import parallel
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Deleting an object from an HDF5 file only unlinks it; the file does not shrink, and the space is only reused
+# if something else is written to the same file later.  Over a campaign the storage files accumulate
+#
+#   - results for rows we decided we did not want,
+#   - orphans: results at paths no row of the input file (nor any row recorded with catalog.keep, like adaptive.py's) describes, and
+#   - dangling ExternalLinks that Parallelize._gather made to shards that have since been deleted,
+#
+# and the only way to get the space back is to copy what we want to keep into a new file.
+#
+# This garbage collector deletes the selected results, and optionally the orphans and dangling links,
+# and then repacks every file it touched and reports how many bytes it freed.
+
+# The cached steps, in the order they are computed.
+cached = (steps.GeneratorChoice, steps.Thermalization, steps.Ensemble, steps.Bootstrap)
+
+def links(group, prefix=''):
+    r'''
+    Yields (path, link) for every link in the group and, recursively, in every group it holds,
+    without following ExternalLinks or SoftLinks.
+    '''
+    for key in group:
+        link = group.get(key, getlink=True)
+        yield f'{prefix}{key}', link
+        if isinstance(link, h5.HardLink) and isinstance(group.get(key), h5.Group):
+            yield from links(group[key], f'{prefix}{key}/')
+
+def dangling(filename):
+    r'''
+    The paths in the file of ExternalLinks whose target file or object does not exist.
+    '''
+    found = deque()
+    directory = Path(filename).parent
+    with h5.File(filename, 'r') as file:
+        for path, link in links(file):
+            if not isinstance(link, h5.ExternalLink):
+                continue
+            target = Path(link.filename)
+            target = target if target.is_absolute() or target.exists() else directory / target
+            try:
+                with h5.File(target, 'r') as other:
+                    if link.path not in other:
+                        found.append(path)
+            except OSError:
+                found.append(path)
+    return list(found)
+
+def expected(ensembles):
+    r'''
+    A dictionary from each storage file to the paths the rows' cached steps are stored at in it.
+    '''
+    paths = dict()
+    for idx, row in ensembles.iterrows():
+        for step in cached:
+            try:
+                f, path = step.target(row)
+            except KeyError:
+                continue
+            # Rows from different sources may not all have every storage.
+            if isinstance(f, str):
+                paths.setdefault(os.path.abspath(f), set()).add(path.strip('/'))
+        # In a --parallel computation the gathered files hold ExternalLinks at the rows' paths.
+        for column, value in row.items():
+            if column.endswith(' gather') and isinstance(value, str):
+                storage = column[:-len(' gather')]
+                for path in (row['path'], *parallel.gathered(row, storage)):
+                    paths.setdefault(os.path.abspath(value), set()).add(path.strip('/'))
+    return paths
+
+def orphans(filename, keep):
+    r'''
+    The paths in the file that are not one of the paths to keep, nor a group on the way to one.
+    '''
+    prefixes = set('/'.join(p.split('/')[:i]) for p in keep for i in range(1, p.count('/')+1))
+
+    found = deque()
+    def walk(group, prefix):
+        for key in group:
+            path = f'{prefix}{key}'
+            if path in keep:
+                continue
+            link = group.get(key, getlink=True)
+            if path in prefixes and isinstance(link, h5.HardLink):
+                walk(group[key], f'{path}/')
+            else:
+                found.append(path)
+
+    with h5.File(filename, 'r') as file:
+        walk(file, '')
+    return list(found)
+
+def delete(filename, paths):
+    with h5.File(filename, 'a') as file:
+        for path in paths:
+            try:
+                del file[path]
+                logger.info(f'Deleted {filename}/{path}')
+            except KeyError:
+                logger.debug(f'{filename}/{path} does not exist.')
+
+def repack(filename):
+    r'''
+    Rewrite the file with only what is reachable in it, reclaiming the space of anything deleted.
+    Links (including dangling ones) are copied as links; nothing is pulled in from other files.
+    Returns the bytes freed.
+    '''
+    before = Path(filename).stat().st_size
+    temporary = f'{filename}.repack'
+
+    with h5.File(filename, 'r') as source, h5.File(temporary, 'w') as destination:
+        for key in source:
+            link = source.get(key, getlink=True)
+            if isinstance(link, (h5.ExternalLink, h5.SoftLink)):
+                destination[key] = link
+            else:
+                # Copying an object keeps its chunking and filters, and keeps the links inside it as links.
+                source.copy(source[key], destination, name=key)
+        for key, value in source.attrs.items():
+            destination.attrs[key] = value
+
+    os.replace(temporary, filename)
+    after = Path(filename).stat().st_size
+    logger.info(f'Repacked {filename} from {before} to {after} bytes.')
+    return before - after
+
+def collect(ensembles, remove=(), everything=(), orphaned=False, danglers=False, pack=False, dry_run=False):
+    r'''
+    Garbage-collect the storage of the ensembles.
+
+      - remove is a collection of cached step names whose results for the given rows are deleted,
+      - everything is a dataframe of all the rows whose data should be kept; needed to find orphans,
+      - orphaned and danglers say whether to delete orphans and dangling ExternalLinks, and
+      - pack says whether to repack every file, not only the ones something was deleted from.
+
+    Returns a dataframe of what was (or, in a dry run, would be) deleted from each file and the bytes freed.
+    '''
+    doomed = dict()
+    for idx, row in ensembles.iterrows():
+        for step in cached:
+            if step.__name__ not in remove:
+                continue
+            f, path = step.target(row)
+            if Path(f).exists():
+                doomed.setdefault(os.path.abspath(f), deque()).append((step, row, path))
+
+    files = set(doomed) | set(f for f in expected(ensembles) if Path(f).exists())
+    report = deque()
+    for f in sorted(files):
+        paths = [path for step, row, path in doomed.get(f, ())]
+        if orphaned:
+            paths += orphans(f, expected(everything).get(f, set()))
+        if danglers:
+            paths += dangling(f)
+        paths = list(dict.fromkeys(paths))
+
+        entry = {'file': f, 'deleted': len(paths), 'paths': paths, 'freed': 0}
+        if not dry_run:
+            if paths:
+                delete(f, paths)
+                for step, row, path in doomed.get(f, ()):
+                    steps.catalog.forget(step.__name__, f, path)
+            if paths or pack:
+                entry['freed'] = repack(f)
+        report.append(entry)
+
+    return pd.DataFrame(report, columns=['file', 'deleted', 'paths', 'freed'])
+
+if __name__ == '__main__':
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('input_file', type=supervillain.cli.input_file('input'), default='input.py')
+    parser.add_argument('--parallel', default=False, action='store_true')
+    parser.add_argument('--W', default=None, type=int)
+    parser.add_argument('--N', default=None, type=int)
+    parser.add_argument('--kappa', default=None, type=float)
+    parser.add_argument('--action', default=None, type=str, choices=('Villain', 'Worldline'))
+    parser.add_argument('--delete', default=(), type=str, nargs='+', choices=tuple(s.__name__ for s in cached),
+                        help='Delete these steps of the selected rows.')
+    parser.add_argument('--orphans', default=False, action='store_true', help='Delete whatever no row of the input file, nor any row kept in the catalog, describes.')
+    parser.add_argument('--dangling', default=False, action='store_true', help='Delete ExternalLinks to shards that no longer exist.')
+    parser.add_argument('--repack', default=False, action='store_true', help='Repack every storage file, even if nothing was deleted from it.')
+    parser.add_argument('--dry-run', default=False, action='store_true', help='Only report what would be deleted.')
+
+    args = parser.parse_args()
+
+    everything = args.input_file.ensembles
+    if args.parallel:
+        from parallel import io_prep
+        everything = everything.apply(io_prep, axis=1)
+
+    ensembles = everything
+    if args.orphans:
+        # Without the catalog we cannot know about rows that other scripts made, and would delete their data.
+        if not steps.catalog.file:
+            parser.error('Finding orphans needs the catalog, which records the rows no input file describes.')
+        kept = steps.catalog.kept()
+        if args.parallel and not kept.empty:
+            kept = kept.apply(lambda row: io_prep(row.dropna()), axis=1)
+        everything = pd.concat([everything, kept], ignore_index=True)
+    if args.W:
+        ensembles = ensembles[ensembles['W'] == args.W]
+    if args.N:
+        ensembles = ensembles[ensembles['N'] == args.N]
+    if args.kappa:
+        ensembles = ensembles[ensembles['kappa'] == args.kappa]
+    if args.action:
+        ensembles = ensembles[ensembles['action'] == args.action]
+
+    with Timer(logger.info, 'Garbage collection'):
+        report = collect(ensembles, remove=args.delete, everything=everything,
+                         orphaned=args.orphans, danglers=args.dangling, pack=args.repack, dry_run=args.dry_run)
+
+    with pd.option_context('display.max_rows', None, 'display.max_colwidth', 80, 'display.width', 1000):
+        print(report[['file', 'deleted', 'freed']])
+        if args.dry_run:
+            for idx, r in report.iterrows():
+                for p in r['paths']:
+                    print(f"would delete {r['file']}/{p}")
+
+    print(f"{'Would delete' if args.dry_run else 'Deleted'} {report['deleted'].sum()} objects; freed {report['freed'].sum()} bytes.")
@@ -1,15 +1,94 @@
 
 from collections import deque
+from threading import Thread, Condition
 import pandas as pd
+import h5py as h5
 
 import supervillain
 import steps
+import measurement
+from reweighting import ingredients
+import catalog
 
 import logging
 logger = logging.getLogger(__name__)
 
 # Here are some utilities for collecting data.
 
+# Reading ensembles and bootstraps from disk and plotting or analyzing them take turns, unless we read ahead.
+# prefetch reads up to ahead items on a background thread while the consumer works on the current one
+# (h5py reads do not need the interpreter), but holds no more than roughly memory bytes of them at once,
+# counting the item the consumer is working on.  So that the budget is checked before an item is read,
+# size(item) estimates its bytes beforehand; stored(step) estimates them from the uncompressed size of the step's stored result.
+# With ahead=0 it just reads synchronously.
+def prefetch(items, read, ahead=2, memory=2**30, size=lambda item: 0):
+    if ahead < 1:
+        yield from (read(item) for item in items)
+        return
+
+    ready = deque()
+    held = 0
+    done = False
+    stop = False
+    condition = Condition()
+
+    def producer():
+        nonlocal held, done
+        try:
+            for item in items:
+                estimate = size(item)
+                with condition:
+                    # A single item bigger than the budget is allowed, but only on its own.
+                    condition.wait_for(lambda: stop or (len(ready) < ahead and (held == 0 or held + estimate <= memory)))
+                    if stop:
+                        return
+                    held += estimate
+                value = read(item)
+                with condition:
+                    ready.append((value, estimate, None))
+                    condition.notify_all()
+        except Exception as e:
+            with condition:
+                ready.append((None, 0, e))
+        finally:
+            with condition:
+                done = True
+                condition.notify_all()
+
+    thread = Thread(target=producer, daemon=True)
+    thread.start()
+    current = 0
+    try:
+        while True:
+            with condition:
+                # The consumer is done with the previous item.
+                held -= current
+                current = 0
+                condition.notify_all()
+
+                condition.wait_for(lambda: ready or done)
+                if not ready:
+                    return
+                value, current, exception = ready.popleft()
+            if exception is not None:
+                raise exception
+            yield value
+    finally:
+        with condition:
+            stop = True
+            condition.notify_all()
+
+def stored(step):
+    # Storage policies compress the data several-fold, so we count the uncompressed bytes.
+    def size(row):
+        f, path = step.target(row)
+        try:
+            with h5.File(f, 'r') as file:
+                return catalog.unpacked(file[path])
+        except Exception:
+            return 0
+    return size
+
 
 # collect produces a dataframe with essentially all observables for each bootstrapped ensemble on disk.
 def collect(ensembles, observables=()):
@@ -20,14 +99,23 @@ def collect(ensembles, observables=()):
 
         observables = supervillain.observables | supervillain.derivedQuantities
 
-    for idx, row in ensembles.iterrows():
+    # Primary observables missing from a Bootstrap's ensemble are measured and stored with it, but only once we are done
+    # reading, because the prefetcher may have the same files open (see measurement.ensure).
+    pending = deque()
+
+    rows = [row for idx, row in ensembles.iterrows()]
+    for row, B in zip(rows, prefetch(rows, steps.Possible(steps.Bootstrap).of, size=stored(steps.Bootstrap))):
 
         for line in str(row).split('\n'):
             logger.info(line)
-        if not (B := steps.Possible(steps.Bootstrap).of(row)):
+        if not B:
             logger.info('Bootstrap not available.')
             continue
 
+        f, path = steps.Bootstrap.target(row)
+        needed = set(i for o in observables for i in ingredients(o, B.Action))
+        measurement.ensure(B.Ensemble, needed, (f, f'{path}/Ensemble', None), measurement.workers(row), pending=pending)
+
         for o in observables:
             (mean, std) = B.estimate(o)
             row[o] = mean
@@ -35,16 +123,17 @@ def collect(ensembles, observables=()):
 
         data.append(row)
 
+    measurement.flush(pending)
     return pd.DataFrame(data)
 
 # Here is an iterator which loops over all the ensembles on disk.
 # It returns the ensemble, not the dataframe row.
-def ensembles(df):
+def ensembles(df, ahead=2, memory=2**30):
     r'''
-    A generator which emits ensembles that are really on disk.
+    A generator which emits ensembles that are really on disk, reading up to ahead of them in the background.
     '''
-    for idx, row in df.iterrows():
-        if not (E:=steps.Possible(steps.Ensemble).of(row)):
+    for E in prefetch((row for idx, row in df.iterrows()), steps.Possible(steps.Ensemble).of, ahead=ahead, memory=memory, size=stored(steps.Ensemble)):
+        if not E:
             continue
         yield E
 
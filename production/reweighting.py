@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+
+import inspect
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+import supervillain
+from supervillain.performance import Timer
+import steps
+
+import logging
+logger = logging.getLogger(__name__)
+
+# To draw a smooth curve through κ we need not simulate every κ on the curve.
+# Ensembles at nearby κ with the same W, N, and action sample overlapping regions of configuration space,
+# and multi-histogram reweighting (Ferrenberg and Swendsen, PRL 63 (1989) 1195) combines all of them
+# into an estimate of any expectation value at any κ between them.
+#
+# The reweighting only needs to know how the action of each configuration changes with κ.
+# Both of our actions have the form
+#
+#     S_κ(x) = κ^p X(x) + c(κ)
+#
+# with p=+1 in the Villain frame and p=-1 in the Worldline frame, where c(κ) does not depend on the configuration
+# and cancels from the normalized weights.  We do not get X from the ActionDensity each ensemble measured:
+# in the Worldline frame that carries κ-dependent terms of its own, which would give X an offset that depends on which κ
+# the configuration came from.  Instead we evaluate the action itself at two values of κ,
+#
+#     X(x) = (S_κ1(x) - S_κ2(x)) / (κ1^p - κ2^p),
+#
+# and check, on every ensemble, that κ^p X reproduces that ensemble's own action up to a constant.
+power = {
+    'Villain':   +1,
+    'Worldline': -1,
+}
+
+def logsumexp(a, axis):
+    m = np.max(a, axis=axis, keepdims=True)
+    return np.squeeze(m, axis=axis) + np.log(np.sum(np.exp(a - m), axis=axis))
+
+class Reweighting:
+
+    def __init__(self, ensembles, action, probes, tolerance=1e-10, iterations=10000):
+        r'''
+        Combine the ensembles, all of the same W, N, and action, which differ only in κ.
+        The probes are actions of the same W, N, and action at different κ; X is evaluated with the first two,
+        and κ^p X is checked against every probe's action and every ensemble's own.
+        '''
+
+        self.ensembles = ensembles
+        self.p = power[action]
+        self.kappa = np.array([E.Action.kappa for E in ensembles])
+        self.count = np.array([len(E) for E in ensembles])
+
+        self.X = np.concatenate([self.reduce(E, probes) for E in ensembles])
+        # Which ensemble each configuration came from.
+        self.source = np.repeat(np.arange(len(ensembles)), self.count)
+
+        self.tolerance = tolerance
+        self.iterations = iterations
+        self.f = self.free_energies(np.arange(len(self.X)))
+
+        self._primary = dict()
+
+    def reduce(self, E, probes, tolerance=1e-6):
+        a, b = probes[:2]
+        X = np.array([(evaluate_action(a, x) - evaluate_action(b, x)) / (a.kappa**self.p - b.kappa**self.p) for x in configurations(E)])
+
+        # κ^p X must reproduce the action, up to a constant, at every κ we can check.
+        for S in (E.Action, *probes[2:]):
+            S_x = np.array([evaluate_action(S, x) for x in configurations(E)])
+            residual = S_x - S.kappa**self.p * X
+            if np.ptp(residual) > tolerance * max(1, np.abs(S_x).max()):
+                raise ValueError(f'The {S.__class__.__name__} action at κ={S.kappa} is not κ^{self.p} X + c(κ); the spread is {np.ptp(residual)}.')
+        return X
+
+    def reduced(self, kappa, configurations):
+        # The κ-dependent part of the action of the configurations, for each κ.
+        return np.outer(np.asarray(kappa)**self.p, self.X[configurations])
+
+    def free_energies(self, configurations, f=None):
+        r'''
+        Solve the self-consistent multi-histogram equations for the dimensionless free energies f, fixing f[0]=0,
+        using only the given configurations (which may be a resampling).
+        '''
+        count = np.bincount(self.source[configurations], minlength=len(self.kappa))
+        u = self.reduced(self.kappa, configurations)
+        f = np.zeros(len(self.kappa)) if f is None else f.copy()
+
+        for iteration in range(self.iterations):
+            denominator = logsumexp(np.log(count)[:, None] + f[:, None] - u, axis=0)
+            new = -logsumexp(-u - denominator[None, :], axis=1)
+            new -= new[0]
+            if np.max(np.abs(new - f)) < self.tolerance:
+                return new
+            f = new
+
+        logger.warning(f'The free energies did not converge to {self.tolerance} in {self.iterations} iterations.')
+        return f
+
+    def weights(self, kappa, configurations, f):
+        r'''
+        The normalized weight of each configuration at each target κ, with shape [len(kappa), len(configurations)].
+        '''
+        count = np.bincount(self.source[configurations], minlength=len(self.kappa))
+        denominator = logsumexp(np.log(count)[:, None] + f[:, None] - self.reduced(self.kappa, configurations), axis=0)
+        log_w = -self.reduced(kappa, configurations) - denominator[None, :]
+        return np.exp(log_w - logsumexp(log_w, axis=1)[:, None])
+
+    def primary(self, name):
+        if name not in self._primary:
+            self._primary[name] = np.concatenate([getattr(E, name) for E in self.ensembles])
+        return self._primary[name]
+
+    def expectation(self, kappa, names, configurations=None, f=None):
+        r'''
+        The reweighted expectation value of each primary observable at each target κ, vectorized over the targets.
+        '''
+        configurations = np.arange(len(self.X)) if configurations is None else configurations
+        f = self.f if f is None else f
+        w = self.weights(kappa, configurations, f)
+        return {n: np.einsum('tc,c...->t...', w, self.primary(n)[configurations]) for n in names}
+
+    def bootstrap(self, kappa, names, draws, rng=None):
+        r'''
+        Expectation values with a leading bootstrap axis, shape [draws, len(kappa), ...].
+        Each draw resamples every ensemble separately and re-solves for the free energies.
+        '''
+        rng = np.random.default_rng() if rng is None else rng
+        offsets = np.concatenate(([0], np.cumsum(self.count)[:-1]))
+
+        samples = {n: deque() for n in names}
+        for d in range(draws):
+            configurations = np.concatenate([o + rng.integers(0, c, c) for o, c in zip(offsets, self.count)])
+            f = self.free_energies(configurations, self.f)
+            for n, v in self.expectation(kappa, names, configurations, f).items():
+                samples[n].append(v)
+
+        return {n: np.stack(v) for n, v in samples.items()}
+
+def configurations(E):
+    return (E.configuration[i] for i in range(len(E)))
+
+def evaluate_action(S, x):
+    return S(**getattr(x, 'fields', x)).real
+
+# Derived quantities are functions of the expectation values of primary observables.
+# supervillain knows which primaries each needs from the names of its implementation's arguments.
+def implementation(name, S):
+    D = supervillain.derivedQuantities[name]
+    return getattr(D, S.__class__.__name__, None) or getattr(D, 'default')
+
+def ingredients(name, S):
+    if name in supervillain.observables:
+        return (name, )
+    return tuple(list(inspect.signature(implementation(name, S)).parameters)[1:])
+
+def evaluate(name, S, expectations):
+    if name in supervillain.observables:
+        return expectations[name]
+    return implementation(name, S)(S, *(expectations[i] for i in ingredients(name, S)))
+
+def reweight(ensembles, observables, points=100, draws=100):
+    r'''
+    For each (W, N, action) in the ensembles dataframe, reweight the stored ensembles to a dense grid of κ
+    covering the simulated ones.  Returns a dataframe like results.collect, with one row per (W, N, action, κ).
+    '''
+    data = deque()
+
+    for (W, N, action), rows in ensembles.groupby(['W', 'N', 'action']):
+        available = [(row, E) for idx, row in rows.sort_values(by='kappa').iterrows() if (E := steps.Possible(steps.Ensemble).of(row)) is not None]
+        if len(available) < 2:
+            logger.info(f'Fewer than two ensembles for W={W} N={N} {action}; not reweighting.')
+            continue
+
+        with Timer(logger.info, f'Reweighting W={W} N={N} {action}'):
+            template = available[0][0]
+            # Any two distinct κ will do to find X; we use the ends of the range.
+            # With only two ensembles the check against their own actions cannot fail, so we also check at the midpoint.
+            midpoint = template.copy()
+            midpoint['kappa'] = (available[0][0]['kappa'] + available[-1][0]['kappa']) / 2
+            probes = [steps.Action.of(r) for r in (available[0][0], available[-1][0], midpoint)]
+
+            # Just like the Bootstrap step, we only use decorrelated configurations.
+            try:
+                R = Reweighting([E.every(E.tau) for row, E in available], action, probes)
+            except ValueError as error:
+                logger.error(f'Not reweighting W={W} N={N} {action}: {error}')
+                continue
+            kappa = np.linspace(R.kappa.min(), R.kappa.max(), points)
+
+            S = steps.Action.of(template)
+            needed = sorted(set(i for o in observables for i in ingredients(o, S)))
+
+            central = R.expectation(kappa, needed)
+            samples = R.bootstrap(kappa, needed, draws)
+
+            for t, k in enumerate(kappa):
+                row = template.copy()
+                row['kappa'] = k
+                S = steps.Action.of(row)
+
+                for o in observables:
+                    # Derived quantities expect a leading bootstrap axis, so the central value gets one too.
+                    row[o] = evaluate(o, S, {n: v[None, t] for n, v in central.items()})[0]
+                    row[f'{o}±'] = evaluate(o, S, {n: v[:, t] for n, v in samples.items()}).std(axis=0)
+                data.append(row)
+
+    return pd.DataFrame(data)
+
+if __name__ == '__main__':
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('input_file', type=supervillain.cli.input_file('input'), default='input.py')
+    parser.add_argument('--parallel', default=False, action='store_true')
+    parser.add_argument('--observables', type=str, nargs='+', default=('SpinCriticalMoment', 'VortexCriticalMoment'))
+    parser.add_argument('--points', type=int, default=100)
+    parser.add_argument('--draws', type=int, default=100)
+
+    args = parser.parse_args()
+
+    ensembles = args.input_file.ensembles
+    if args.parallel:
+        import parallel
+        ensembles = ensembles.apply(parallel.io_prep, axis=1)
+
+    with pd.option_context('display.max_rows', None, 'display.width', 1000):
+        print(reweight(ensembles, args.observables, points=args.points, draws=args.draws)[['W', 'N', 'action', 'kappa'] + [c for o in args.observables for c in (o, f'{o}±')]])
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pandas as pd
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The order in which we compute the rows of an input file can matter.
+#
+# A row whose 'start' is 'warm' starts its thermalization from the last thermalized configuration of the nearest κ
+# with the same W, N, and action that is already thermalized (see steps.Start).
+# At low κ the Worldline frame rejects many more updates, so it is best to anneal down in κ:
+# each family is computed from the highest κ to the lowest, and each chain starts from the one just above it.
+#
+# A row whose 'start' is 'upscale' starts from a thermalized configuration of a smaller lattice with the same W, κ, and action,
+# tiled up to the row's N.  Small lattices are computed first, so that they are ready when the bigger ones need them.
+
+family = ['W', 'N', 'action']
+tower  = ['W', 'kappa', 'action']
+
+def order(ensembles):
+    r'''
+    Sorts the ensembles into the order in which they should be computed and, if any start 'warm' or 'upscale',
+    lists the ensembles they may start from in a 'warm from' or 'upscale from' column.
+    '''
+
+    warm = (ensembles['start'] == 'warm').any()
+    upscale = (ensembles['start'] == 'upscale').any()
+    ordered = ensembles.sort_values(by=['W', 'N', 'kappa'], ascending=(True, True, not warm))
+
+    if warm:
+        ordered['warm from'] = pd.Series([neighbors(row, ordered) for idx, row in ordered.iterrows()], index=ordered.index, dtype=object)
+    if upscale:
+        ordered['upscale from'] = pd.Series([smaller(row, ordered) for idx, row in ordered.iterrows()], index=ordered.index, dtype=object)
+
+    return ordered
+
+def neighbors(row, ensembles):
+    # The (thermalization storage, path) of every other ensemble in the row's family, nearest κ first.
+    same = ensembles[(ensembles[family] == row[family]).all(axis=1) & (ensembles['path'] != row['path'])]
+    same = same.iloc[(same['kappa'] - row['kappa']).abs().argsort(kind='stable')]
+    return tuple(zip(same['thermalization storage'], same['path']))
+
+def smaller(row, ensembles):
+    # The (thermalization storage, path, N) of every ensemble with the same W, κ, and action whose N divides the row's, biggest first.
+    same = ensembles[(ensembles[['W', 'action']] == row[['W', 'action']]).all(axis=1) & np.isclose(ensembles['kappa'], row['kappa'])]
+    same = same[(same['N'] < row['N']) & (row['N'] % same['N'] == 0)].sort_values(by='N', ascending=False)
+    return tuple(zip(same['thermalization storage'], same['path'], same['N']))
+
+def families(ensembles):
+    r'''
+    How to group rows into tasks for a --parallel computation, so that rows that start from one another
+    are computed in order in the same worker; None if every row is independent.
+    '''
+    warm = (ensembles['start'] == 'warm').any()
+    upscale = (ensembles['start'] == 'upscale').any()
+
+    if warm and upscale:
+        return ['W', 'action']
+    if warm:
+        return family
+    if upscale:
+        return tower
+    return None
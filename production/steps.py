@@ -1,11 +1,21 @@
 #!/usr/bin/env python
 
+import time
+import threading
+from collections import deque, OrderedDict
+
+import numpy as np
 import h5py as h5
 
 import supervillain
 from supervillain.performance import Timer
 from supervillain.h5 import Data
 
+from storage import Storage, store, _bytes
+from timeline import timed
+import catalog
+import measurement
+
 def progress(iterable, **kwargs):
     r'''
     Like `tqdm <https://tqdm.github.io/docs/tqdm/#tqdm-objects>`_, but requires the iterable.
@@ -39,18 +49,89 @@ class Step:
     # A step has prerequisites given in the ingredients list.
     ingredients = dict()
 
+    # If the step is h5_cached its result is written according to its storage policy;
+    # None means supervillain's default layout.
+    storage = None
+
     # To complete the step the ingredients must be prepared and ready.
     @classmethod
     def prep(cls, row):
-        with Timer(logger.info, f'Preparing ingredients for {cls.__name__}'):
+        with timed(logger.info, f'Preparing ingredients for {cls.__name__}', cls.__name__, 'prep', row):
             return {key: i.of(row) for key, i in cls.ingredients.items()}
 
+    @classmethod
+    def read(cls, file, f, path):
+        return supervillain.h5.Data.read(file[path])
+
     # Each step provides its own step.of(row) method.
     # Its job is to actually accomplish the computational step.
     @classmethod
     def of(cls, row):
         raise NotImplementedError()
 
+# When many computations happen in one interpreter (see campaign.py) it pays to also remember
+# results we have already read or computed, rather than reading them from disk again.
+# The memory is None (remember nothing) by default, but can be set to a Memory, which remembers only the results of some steps
+# (by default the Ensembles and Bootstraps the analyses read again and again, not the long Thermalization histories),
+# forgetting the least recently used once they take up more than its limit in bytes.
+memory = None
+
+# results.prefetch reads (and so remembers) on a background thread while the main thread recalls, so a Memory is locked.
+class Memory:
+
+    def __init__(self, steps=('Ensemble', 'Bootstrap'), limit=2*2**30):
+        self.steps = set(steps)
+        self.limit = limit
+        self.used = 0
+        self.results = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.results:
+                return default
+            self.results.move_to_end(key)
+            return self.results[key][0]
+
+    def pop(self, key, default=None):
+        with self.lock:
+            return self._pop(key, default)
+
+    def _pop(self, key, default=None):
+        if key not in self.results:
+            return default
+        result, size = self.results.pop(key)
+        self.used -= size
+        return result
+
+    def __setitem__(self, key, result):
+        if key[0] not in self.steps:
+            return
+        size = _bytes(result)
+        with self.lock:
+            self._pop(key)
+            if size > self.limit:
+                return
+            self.results[key] = (result, size)
+            self.used += size
+            while self.used > self.limit:
+                self._pop(next(iter(self.results)))
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+            self.used = 0
+
+def recall(cls, f, path):
+    if memory is None:
+        return None
+    return memory.get((cls.__name__, f, path), None)
+
+def remember(cls, f, path, result):
+    if memory is not None:
+        memory[(cls.__name__, f, path)] = result
+    return result
+
 # Some of the steps are so costly that we store the results in an hdf5 file for later re-use.
 def h5_cached(decorated_cls):
 
@@ -68,21 +149,40 @@ def h5_cached(decorated_cls):
         @classmethod
         def of(cls, row):
             f, path = cls.target(row)
+            if (result := recall(cls, f, path)) is not None:
+                return result
+
             logger.info(f'Checking {f}/{path}... ')
             try:
-                with h5.File(f, 'r') as file:
-                    return supervillain.h5.Data.read(file[path])
+                with timed(logger.info, f'Reading {cls.__name__}', cls.__name__, 'read', row):
+                    with h5.File(f, 'r') as file:
+                        return remember(cls, f, path, cls.read(file, f, path))
             except:
-                with Timer(logger.info, f'Constructing {cls.__name__}'):
+                start = time.perf_counter()
+                with timed(logger.info, f'Constructing {cls.__name__}', cls.__name__, 'compute', row):
                     result = decorated_cls.of(row)
-                    try:
-                        with h5.File(f, 'a') as file:
-                            supervillain.h5.Data.write(file, path, result)
-                    except Exception as e:
-                        raise e from None
+                cls.write(row, result, seconds=time.perf_counter() - start)
 
-            return result
+            return remember(cls, f, path, result)
 
+        # Results computed some other way (for example, many at once) can be stored as though the step computed them.
+        # Every write is also recorded in the catalog.
+        @classmethod
+        def write(cls, row, result, seconds=None):
+            f, path = cls.target(row)
+            with timed(logger.info, f'Writing {cls.__name__}', cls.__name__, 'write', row):
+                try:
+                    with h5.File(f, 'a') as file:
+                        store(file, path, result, cls.storage)
+                        nbytes = catalog.size(file[path])
+                except Exception as e:
+                    raise e from None
+
+            catalog.record(cls.__name__, row, f, path, result, nbytes=nbytes, seconds=seconds)
+
+            return remember(cls, f, path, result)
+
+        # Deleting only unlinks the result; the file keeps its size until it is repacked (see reclaim.py).
         @classmethod
         def delete_h5(cls, row):
 
@@ -92,7 +192,11 @@ def h5_cached(decorated_cls):
                 with h5.File(f, 'a') as file:
                     del file[path]
             except Exception as e:
-                raise e from NOne
+                raise e from None
+
+            catalog.forget(cls.__name__, f, path)
+            if memory is not None:
+                memory.pop((cls.__name__, f, path), None)
 
     Curried.__name__ = decorated_cls.__name__
 
@@ -109,10 +213,13 @@ def Possible(maybe_cls):
         @classmethod
         def of(cls, row):
             f, path = cls.target(row)
+            if (result := recall(cls, f, path)) is not None:
+                return result
             try:
                 # which will give the true value if it is available
-                with h5.File(f, 'r') as file:
-                    return supervillain.h5.Data.read(file[path])
+                with timed(logger.debug, f'Reading {cls.__name__}', cls.__name__, 'read', row):
+                    with h5.File(f, 'r') as file:
+                        return remember(cls, f, path, cls.read(file, f, path))
             except Exception as e:
                 # and will return None otherwise.
                 return None
@@ -155,6 +262,60 @@ class Action(Step):
         # And then do the computational step itself.
         return (supervillain.action.Villain if row['action'] == 'Villain' else supervillain.action.Worldline)(cooked['lattice'], row['kappa'], row['W'])
 
+# Which generator a row uses is chosen by its 'generator' column, from this registry of constructors (given the action).
+# Rows without a generator use the 'hammer', which updates every field and has worms on every plaquette (Villain) or site (Worldline).
+# The sparse and dense variants change how many worms the Hammer makes per update, the local generators make no worms at all,
+# and the mixed generators sweep locally before each Hammer update.
+#
+# The local generators never change the vortices (Villain) or the winding sectors (Worldline), so for W>1 they are not ergodic;
+# they are only for experiments, and are never among the 'auto' candidates.
+generators = {
+    'Villain': {
+        'hammer':        lambda S: supervillain.generator.villain.Hammer(S, S.Lattice.plaquettes),
+        'sparse hammer': lambda S: supervillain.generator.villain.Hammer(S, max(1, S.Lattice.plaquettes // 4)),
+        'dense hammer':  lambda S: supervillain.generator.villain.Hammer(S, 4 * S.Lattice.plaquettes),
+        'local':         lambda S: supervillain.generator.combining.Sequentially((
+                                        supervillain.generator.villain.SiteUpdate(S),
+                                        supervillain.generator.villain.LinkUpdate(S),
+                                        )),
+        'mixed':         lambda S: supervillain.generator.combining.Sequentially((
+                                        supervillain.generator.villain.SiteUpdate(S),
+                                        supervillain.generator.villain.LinkUpdate(S),
+                                        supervillain.generator.villain.Hammer(S, S.Lattice.plaquettes),
+                                        )),
+    },
+    'Worldline': {
+        'hammer':        lambda S: supervillain.generator.worldline.Hammer(S, S.Lattice.sites),
+        'sparse hammer': lambda S: supervillain.generator.worldline.Hammer(S, max(1, S.Lattice.sites // 4)),
+        'dense hammer':  lambda S: supervillain.generator.worldline.Hammer(S, 4 * S.Lattice.sites),
+        'local':         lambda S: supervillain.generator.combining.Sequentially((
+                                        supervillain.generator.worldline.PlaquetteUpdate(S),
+                                        supervillain.generator.worldline.WrappingUpdate(S),
+                                        )),
+        'mixed':         lambda S: supervillain.generator.combining.Sequentially((
+                                        supervillain.generator.worldline.PlaquetteUpdate(S),
+                                        supervillain.generator.worldline.WrappingUpdate(S),
+                                        supervillain.generator.worldline.Hammer(S, S.Lattice.sites),
+                                        )),
+    },
+}
+
+incomplete = ('local', )
+
+def generator(row):
+    # A row's choice of generator, 'hammer' if it does not say.
+    name = row.get('generator', 'hammer')
+    name = name if isinstance(name, str) else 'hammer'
+    if name in incomplete and row['W'] > 1:
+        logger.warning(f"The {name} generator is not ergodic for W={row['W']}; {row['path']} will not sample the right distribution.")
+    return name
+
+def construct(action, name, S):
+    try:
+        return generators[action][name](S)
+    except KeyError:
+        raise ValueError(f"Unknown {action} generator {name}; choose from {tuple(generators.get(action, {}))} or 'auto'.") from None
+
 class Generator(Step):
 
     ingredients = {
@@ -165,14 +326,129 @@ class Generator(Step):
     def of(cls, row):
 
         S = cls.prep(row)['action']
-        L = S.Lattice # We can pull out previously-computed objects rather than put them into the ingredient list.
 
-        if row['action'] == 'Villain':
-            return supervillain.generator.villain.Hammer(S, L.plaquettes)
-        elif row['action'] == 'Worldline':
-            return supervillain.generator.worldline.Hammer(S, L.sites)
+        if row['action'] not in generators:
+            raise ValueError(f"Unknown action {row['action']}")
+
+        if (name := generator(row)) == 'auto':
+            name = choice(GeneratorChoice.of(row))
+
+        return construct(row['action'], name, S)
+
+# Usually a thermalization starts from row['start'], which is 'cold'.
+# But thermalization is much cheaper if we can start from a configuration that is already close to equilibrium,
+# such as a thermalized configuration of the same lattice and action at a nearby κ.
+# A row whose start is 'warm' is given candidates in its 'warm from' column, nearest first,
+# as (thermalization storage, path) pairs by schedule.order, and we start from the first that is available.
+#
+# Similarly, a row whose start is 'upscale' is given (thermalization storage, path, N) candidates in its 'upscale from' column
+# for smaller lattices whose N divides the row's N.  We tile the first available configuration up to the row's size.
+# Because the tiled lattice is a cover of the small one, every local constraint (such as a conserved worldline current)
+# that held on the small lattice holds on the big one, and every field stays integer-valued.
+class Start(Step):
+
+    @classmethod
+    def of(cls, row):
+
+        if row['start'] == 'warm':
+            for storage, path in row.get('warm from', ()):
+                if (last := cls.last(row, storage, path)) is not None:
+                    logger.info(f'Warm start from {storage}/{path}')
+                    return last
+
+        elif row['start'] == 'upscale':
+            for storage, path, N in row.get('upscale from', ()):
+                if (last := cls.last(row, storage, path)) is not None:
+                    logger.info(f'Upscaled start from {storage}/{path}')
+                    return upscale(last, N, row['N'])
+
+        else:
+            return row['start']
+
+        logger.warning(f"No thermalized configuration to {row['start']} start {row['path']} from is available; starting cold.")
+        return 'cold'
+
+    @classmethod
+    def last(cls, row, storage, path):
+        # The last configuration of an already-thermalized ensemble, if there is one.
+        other = row.copy()
+        other['thermalization storage'] = storage
+        other['path'] = path
+
+        if (T := Possible(Thermalization).of(other)) is not None:
+            return T.configuration[-1]
+        return None
+
+def upscale(configuration, small, big):
+    r'''
+    Tiles every field of a configuration on a small×small lattice to a big×big lattice; small must divide big.
+    '''
+    factor = big // small
+
+    fields = getattr(configuration, 'fields', configuration)
+    tiled = {
+        name: np.tile(field, (1,)*(field.ndim-2) + (factor, factor)) if field.shape[-2:] == (small, small) else field
+        for name, field in fields.items()
+    }
+
+    return tiled if fields is configuration else configuration.__class__(tiled)
+
+# Which generator is best depends on W, N, and κ: the Hammer's worms are expensive, but at low κ in the Worldline frame
+# the local updates barely move.  A row whose generator is 'auto' runs a short trial of every candidate in the registry
+# (or only those listed in the row's 'generator candidates'), and uses the one that makes the most
+# decorrelated configurations per second.
+#
+# The choice is stored alongside the thermalization, so that every process (and every later run) uses the same generator,
+# and the τ the thermalization measured stays correct for the DecorrelatedGenerator.
+@h5_cached
+class GeneratorChoice(Step):
+
+    ingredients = {
+            'action': Action,
+            'start':  Start,
+            }
 
-        raise ValueError(f"Unknown action {row['action']}")
+    @classmethod
+    def target(cls, row):
+        return row['thermalization storage'], f"generator/{row['path']}"
+
+    @classmethod
+    def of(cls, row):
+
+        cooked = cls.prep(row)
+        S = cooked['action']
+        trial = int(row.get('generator trial', 200))
+
+        # Only the rate of decorrelation is judged, not whether the right distribution is sampled, so the incomplete generators are never candidates.
+        candidates = row.get('generator candidates', None)
+        if not isinstance(candidates, (list, tuple)):
+            candidates = tuple(generators[row['action']])
+        candidates = tuple(name for name in candidates if name not in incomplete)
+
+        rates = dict()
+        for name in candidates:
+            G = construct(row['action'], name, S)
+            start = time.perf_counter()
+            E = supervillain.Ensemble(S).generate(trial, G, start=cooked['start'], progress=progress)
+            seconds = time.perf_counter() - start
+
+            # The start may be far from equilibrium, so we only judge the second half of the trial.
+            measurement.measure(E, measurement.scalars())
+            try:
+                tau = E.cut(trial // 2).autocorrelation_time()
+            except Exception as exception:
+                logger.warning(f'Could not estimate τ for the {name} generator: {exception}')
+                tau = trial // 2
+
+            rates[name] = trial / seconds / max(tau, 1)
+            logger.info(f'The {name} generator made {rates[name]:.3g} decorrelated configurations per second (τ={tau})')
+
+        logger.info(f"Choosing the {choice(rates)} generator for {row['path']}")
+        return rates
+
+def choice(rates):
+    # We store the rates of every candidate rather than just the winner, so that one can see how close the contest was.
+    return max(rates, key=rates.get)
 
 
 # Now we are ready to thermalize.
@@ -183,9 +459,12 @@ class Thermalization(Step):
 
     ingredients = {
             'action': Action,
-            'generator': Generator
+            'generator': Generator,
+            'start': Start,
             }
 
+    storage = Storage()
+
     @classmethod
     def target(cls, row):
         return row['thermalization storage'], row['path']
@@ -197,9 +476,9 @@ class Thermalization(Step):
         S = cooked['action']
         G = cooked['generator']
 
-        E = supervillain.Ensemble(S).generate(row['thermalize'], G, start=row['start'], progress=progress)
+        E = supervillain.Ensemble(S).generate(row['thermalize'], G, start=cooked['start'], progress=progress)
 
-        E.measure()
+        measurement.measure(E, measurement.declared(row, 'thermalization'), measurement.workers(row))
         tau = E.autocorrelation_time()
         logger.info(f'Pre-thermalization  τ={tau}')
 
@@ -240,6 +519,8 @@ class Ensemble(Step):
             'thermalization': Thermalization,
             }
 
+    storage = Storage()
+
     @classmethod
     def target(cls, row):
         return row['ensemble storage'], row['path']
@@ -252,9 +533,78 @@ class Ensemble(Step):
         G = cooked['generator']
         last = cooked['thermalization'].configuration[-1]
 
+        target = row.get('target error', None)
+        if target is not None and target == target:  # NaN if only some rows set it
+            return cls.targeted(row, S, G, last, target)
+
         E = supervillain.Ensemble(S).generate(row['configurations'], G, start=last, progress=progress)
 
-        E.measure()
+        return cls.measure(E, measurement.declared(row, 'ensemble'), measurement.workers(row))
+
+    # Rather than a fixed number of configurations, a row may give a 'target error', the relative uncertainty it wants on its
+    # 'target observables' (SpinCriticalMoment by default).  We generate row['configurations'] at first and then more,
+    # as many as the current uncertainty suggests we need (assuming it falls like 1/√configurations), until every target
+    # is met or we reach the 'configurations cap' (10× the configurations by default).
+    @classmethod
+    def targeted(cls, row, S, G, last, target):
+
+        observables = row.get('target observables', ('SpinCriticalMoment', ))
+        observables = (observables, ) if isinstance(observables, str) else tuple(observables)
+        cap = row.get('configurations cap', 10 * row['configurations'])
+        cap = int(10 * row['configurations'] if cap != cap else cap)
+
+        # While deciding whether to stop we estimate each chunk on its own, as the Bootstrap step would (every τth configuration),
+        # and combine the chunks' estimates, weighted by their lengths, as if they were independent; we only measure the scalars
+        # (for τ) on every configuration, and the target observables on the decorrelated ones.  Only once we stop are the chunks
+        # stitched together, once, carrying the scalars over so that no configuration is measured twice.
+        # The declared observables are measured once, at the end.
+        scalars = measurement.scalars()
+        chunks = deque()
+        estimates = deque()
+        more = row['configurations']
+        while True:
+            start = chunks[-1].configuration[-1] if chunks else last
+            chunk = cls.measure(
+                supervillain.Ensemble(S).generate(more, G, start=start, progress=progress),
+                scalars, measurement.workers(row))
+            B = supervillain.analysis.Bootstrap(chunk.every(chunk.tau), row['bootstraps'])
+            chunks.append(chunk)
+            estimates.append({o: B.estimate(o) for o in observables})
+
+            total = sum(len(c) for c in chunks)
+            weights = [len(c) / total for c in chunks]
+            errors = dict()
+            for o in observables:
+                mean = sum(w * e[o][0] for w, e in zip(weights, estimates))
+                std = np.sqrt(sum(w**2 * e[o][1]**2 for w, e in zip(weights, estimates)))
+                # An observable whose mean vanishes has no relative error; we hold its absolute error to the target instead.
+                errors[o] = float(np.max(np.where(mean == 0, np.abs(std), np.abs(std / np.where(mean == 0, 1, mean)))))
+            worst = max(errors.values())
+            logger.info(f'With {total} configurations (τ={[c.tau for c in chunks]}) the relative errors are {errors}; the target is {target}.')
+
+            if worst <= target:
+                break
+            if total >= cap:
+                logger.warning(f"Stopping at the cap of {cap} configurations without reaching a relative error of {target}.")
+                break
+
+            more = int(np.ceil(total * ((worst / target)**2 - 1)))
+            more = min(cap - total, max(more, row['configurations']))
+
+        E = chunked(S, chunks, last, G.stride)
+        for o in scalars:
+            vars(E)[o] = np.concatenate([getattr(c, o) for c in chunks])
+        del chunks, estimates
+        E = cls.measure(E, scalars)
+
+        E = cls.measure(E, measurement.declared(row, 'ensemble'), measurement.workers(row))
+        E.relative_error = worst
+        return E
+
+    @classmethod
+    def measure(cls, E, observables=None, workers=1):
+        # Measure the observables (see measurement.py) and record the autocorrelation time of a production ensemble.
+        measurement.measure(E, observables, workers)
         try:
             tau = E.autocorrelation_time()
             logger.info(f'Production τ={tau}')
@@ -266,7 +616,38 @@ class Ensemble(Step):
 
         return E
 
+# An ensemble generated in chunks is stitched back together by replaying the chunks' configurations.
+# Like the DecorrelatedGenerator it has a stride, and after generation it only remembers the chunks' lengths.
+class Chunked(supervillain.h5.H5able):
+
+    def __init__(self, configurations, stride, chunks):
+        self.configurations = deque(configurations)
+        self.stride = stride
+        self.chunks = chunks
+
+    def step(self, x):
+        return self.configurations.popleft()
+
+    def report(self):
+        return f'Every {self.stride} updates in chunks of {self.chunks} configurations.'
+
+def chunked(S, chunks, start, stride):
+    configurations = [c.configuration[i] for c in chunks for i in range(len(c))]
+    G = Chunked(configurations, stride, np.array([len(c) for c in chunks]))
+    E = supervillain.Ensemble(S).generate(len(configurations), G, start=start)
+    del G.configurations
+    return E
+
 # Finally we bootstrap, for later analysis and plotting.
+#
+# By default we bootstrap only every τth configuration, which is simple but throws away most of what we generated.
+# A row whose 'bootstrap' is 'blocked' or 'moving' instead resamples blocks of consecutive configurations of the whole ensemble;
+# the blocks are long enough ('block factor' τ, 2τ by default) that the correlations inside them are kept and those between them are small.
+#
+#   - blocked resamples the non-overlapping blocks, and
+#   - moving resamples blocks starting anywhere (the moving-block bootstrap), which has a little less variance.
+#
+# The mode and block length are stored with the Bootstrap.
 @h5_cached
 class Bootstrap(Step):
 
@@ -283,6 +664,59 @@ class Bootstrap(Step):
 
         cooked = cls.prep(row)
         E = cooked['ensemble']
-
-        return supervillain.analysis.Bootstrap(E.every(E.tau), row['bootstraps'])
-
+        # A stored ensemble may lack observables that were declared (or invented) since it was made.
+        measurement.ensure(E, measurement.declared(row, 'ensemble') or tuple(supervillain.observables),
+                           Ensemble.target(row) + (Ensemble.storage, ), measurement.workers(row))
+
+        mode = row.get('bootstrap', 'decorrelated')
+        mode = mode if isinstance(mode, str) else 'decorrelated'
+
+        if mode == 'decorrelated':
+            B = supervillain.analysis.Bootstrap(E.every(E.tau), row['bootstraps'])
+            B.block = 1
+        elif mode in ('blocked', 'moving'):
+            factor = row.get('block factor', 2)
+            factor = 2 if factor != factor else factor  # NaN if only some rows set it
+            block = int(max(1, np.ceil(factor * E.tau)))
+            count = int(np.ceil(len(E) / block))
+            # With only a few blocks every draw is nearly the same, and the uncertainties mean little.
+            if count < 3:
+                raise ValueError(f'{len(E)} configurations make only {count} blocks of {block}; generate more or lower the block factor.')
+            if count < 10:
+                logger.warning(f'{len(E)} configurations make only {count} blocks of {block}; the {mode} bootstrap uncertainties are unreliable.')
+
+            B = supervillain.analysis.Bootstrap(E, row['bootstraps'])
+            if B.indices.shape != (len(E), B.draws):
+                raise ValueError(f'Expected bootstrap indices of shape {(len(E), B.draws)}, not {B.indices.shape}.')
+            B.indices = blocks(len(E), B.draws, block, moving=(mode == 'moving'))
+            B.block = block
+            logger.info(f'{mode} bootstrap of {len(E)} configurations in blocks of {block}')
+        else:
+            raise ValueError(f"Unknown bootstrap {mode}; choose from 'decorrelated', 'blocked', or 'moving'.")
+
+        B.mode = mode
+        return B
+
+def blocks(configurations, draws, block, moving=False, rng=None):
+    r'''
+    Resampling indices laid out like a supervillain Bootstrap's, [configuration, draw],
+    but made of whole blocks of consecutive configurations.
+    Every draw has as many configurations as there are; its last block is cut short to fit.
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    count = int(np.ceil(configurations / block))
+
+    if moving:
+        starts = rng.integers(0, configurations - block + 1, (draws, count))
+        # Each draw is a column of whole blocks.
+        return (starts[:, :, None] + np.arange(block)).reshape(draws, count * block)[:, :configurations].T
+
+    # The last of the non-overlapping blocks may be short, so a draw that picks it may need another block to be filled.
+    indices = np.empty((configurations, draws), dtype=int)
+    for draw in range(draws):
+        filled = np.empty(0, dtype=int)
+        while len(filled) < configurations:
+            chosen = (block * rng.integers(0, count, count)[:, None] + np.arange(block)).ravel()
+            filled = np.concatenate((filled, chosen[chosen < configurations]))
+        indices[:, draw] = filled[:configurations]
+    return indices
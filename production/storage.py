@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+
+import numpy as np
+import h5py as h5
+
+import supervillain
+from supervillain.performance import Timer
+
+import logging
+logger = logging.getLogger(__name__)
+
+# supervillain.h5.Data.write lays every dataset out with h5py's defaults: contiguous, uncompressed, and at full width.
+# That is a poor fit for configurations, which are long Monte Carlo histories of mostly-small integers.
+#
+# A Storage policy lets Data.write do its usual job in an in-memory HDF5 file and then transcribes the result
+# into the real file, giving every large numerical dataset
+#
+#   - chunks along the leading (Monte Carlo time) axis, so that reading a stretch of the history is cheap,
+#   - a fast compressor, and
+#   - for integer data, HDF5's scale-offset filter, which packs each chunk into the minimum number of bits.
+#
+# The scale-offset filter is lossless for integers and, unlike casting to a narrower dtype, the data come back
+# with the same dtype they were written with, so nothing downstream can be surprised by an int8.
+class Storage:
+
+    def __init__(self, compression='lzf', compression_opts=None, narrow=True, chunk_bytes=2**20, minimum_bytes=2**12):
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.narrow = narrow
+        self.chunk_bytes = chunk_bytes
+        self.minimum_bytes = minimum_bytes
+
+    def layout(self, dataset):
+        r'''
+        The keyword arguments for ``create_dataset`` that store the dataset according to the policy,
+        or ``None`` if it should just be copied as-is.
+        '''
+        if dataset.dtype.kind not in 'iufc' or dataset.ndim < 1 or dataset.shape[0] < 2:
+            return None
+        if dataset.size * dataset.dtype.itemsize < self.minimum_bytes:
+            return None
+
+        row = dataset.dtype.itemsize * int(np.prod(dataset.shape[1:]))
+        rows = int(max(1, min(dataset.shape[0], self.chunk_bytes // max(row, 1))))
+
+        layout = {
+            'chunks': (rows, *dataset.shape[1:]),
+            'compression': self.compression,
+            'compression_opts': self.compression_opts,
+        }
+        if self.narrow and dataset.dtype.kind in 'iu':
+            layout['scaleoffset'] = 0
+        return layout
+
+    def write(self, file, path, value):
+        with h5.File(f'scratch-{id(value)}.h5', 'w', driver='core', backing_store=False) as scratch:
+            supervillain.h5.Data.write(scratch, 'value', value)
+            # Soft links are absolute, so any that point into the scratch file need to be moved along with the data.
+            moved = (scratch['value'].name, f"{file.name.rstrip('/')}/{path.strip('/')}")
+            self._transcribe(scratch['value'], file, path, moved)
+
+    def _transcribe(self, source, destination, name, moved):
+
+        if isinstance(source, h5.Dataset):
+            if (layout := self.layout(source)) is None:
+                source.file.copy(source, destination, name=name)
+                return
+            target = destination.create_dataset(name, data=source[()], **layout)
+        else:
+            target = destination.create_group(name)
+            for key in source:
+                link = source.get(key, getlink=True)
+                if isinstance(link, h5.ExternalLink):
+                    target[key] = link
+                elif isinstance(link, h5.SoftLink):
+                    target[key] = h5.SoftLink(link.path.replace(*moved, 1))
+                else:
+                    self._transcribe(source[key], target, key, moved)
+
+        for key, value in source.attrs.items():
+            target.attrs[key] = value
+
+# Some policies worth comparing; see the benchmark below.
+policies = {
+    'default': None,
+    'lzf':     Storage(compression='lzf', narrow=False),
+    'narrow':  Storage(compression=None,  narrow=True),
+    'lzf+narrow':   Storage(compression='lzf',  narrow=True),
+    'gzip1+narrow': Storage(compression='gzip', compression_opts=1, narrow=True),
+    'gzip4+narrow': Storage(compression='gzip', compression_opts=4, narrow=True),
+}
+
+def store(file, path, value, policy=None):
+    if policy is None:
+        supervillain.h5.Data.write(file, path, value)
+    else:
+        policy.write(file, path, value)
+
+####
+#### Benchmark
+####
+
+# To decide on a policy we write and read some real data under each policy and compare throughput and size.
+def benchmark(results, policies=policies, scratch='storage-benchmark.h5', repeat=3):
+    from pathlib import Path
+    from time import perf_counter
+    import pandas as pd
+
+    results = list(results)
+    memory = sum(_bytes(r) for r in results)
+    logger.info(f'Benchmarking storage of {len(results)} results, {memory/2**20:.1f} MiB in memory.')
+
+    rows = []
+    for name, policy in policies.items():
+        write_time = float('inf')
+        read_time  = float('inf')
+
+        for _ in range(repeat):
+            Path(scratch).unlink(missing_ok=True)
+
+            start = perf_counter()
+            with h5.File(scratch, 'w') as file:
+                for i, r in enumerate(results):
+                    store(file, f'{i}', r, policy)
+            write_time = min(write_time, perf_counter() - start)
+
+            start = perf_counter()
+            with h5.File(scratch, 'r') as file:
+                for i, _ in enumerate(results):
+                    supervillain.h5.Data.read(file[f'{i}'])
+            read_time = min(read_time, perf_counter() - start)
+
+        size = Path(scratch).stat().st_size
+        Path(scratch).unlink()
+
+        rows.append({
+            'policy': name,
+            'size (MiB)': size / 2**20,
+            'ratio': memory / size,
+            'write (MiB/s)': memory / 2**20 / write_time,
+            'read (MiB/s)': memory / 2**20 / read_time,
+            })
+        logger.info(f'{name}: {rows[-1]}')
+
+    return pd.DataFrame(rows).set_index('policy')
+
+def _bytes(value, seen=None):
+    # A rough in-memory size: the sum of the numpy arrays that hang off an object.
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(_bytes(v, seen) for v in value.values())
+    if hasattr(value, '__dict__'):
+        return sum(_bytes(v, seen) for v in vars(value).values())
+    return 0
+
+if __name__ == '__main__':
+
+    import pandas as pd
+    import steps
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('input_file', type=supervillain.cli.input_file('input'), default='input.py')
+    parser.add_argument('--parallel', default=False, action='store_true')
+    parser.add_argument('--step', default='Ensemble', choices=('Thermalization', 'Ensemble', 'Bootstrap'))
+    parser.add_argument('--rows', default=4, type=int, help='How many stored results to benchmark with.')
+    parser.add_argument('--repeat', default=3, type=int)
+    parser.add_argument('--scratch', default='storage-benchmark.h5', type=str)
+
+    args = parser.parse_args()
+
+    ensembles = args.input_file.ensembles
+    if args.parallel:
+        import parallel
+        ensembles = ensembles.apply(parallel.io_prep, axis=1)
+
+    step = steps.Possible(getattr(steps, args.step))
+    results = (r for idx, row in ensembles.iterrows() if (r := step.of(row)) is not None)
+    results = [r for r, _ in zip(results, range(args.rows))]
+    if not results:
+        raise ValueError(f'No stored {args.step} results to benchmark with.')
+
+    with Timer(logger.info, 'Storage benchmark'):
+        table = benchmark(results, scratch=args.scratch, repeat=args.repeat)
+
+    with pd.option_context('display.width', 1000, 'display.float_format', '{:.3f}'.format):
+        print(table)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+
+from collections import deque
+from multiprocessing import Process, Pipe
+
+import numpy as np
+import pandas as pd
+
+import supervillain
+from supervillain.performance import Timer
+import steps
+import measurement
+import transport
+
+import logging
+logger = logging.getLogger(__name__)
+
+# At low κ the Worldline frame rejects many updates and the autocorrelation time grows enormously,
+# while at higher κ the same lattice decorrelates quickly.
+# In parallel tempering (replica exchange) we run one replica per κ of a (W, N, action) family, each in its own process,
+# and every so often propose to swap the configurations of replicas at neighboring κ, accepting with probability
+#
+#     min(1, exp(S_a(x_a) + S_b(x_b) - S_a(x_b) - S_b(x_a)))
+#
+# which keeps every κ's ensemble distributed correctly, while letting slow low-κ configurations
+# wander up to high κ, decorrelate, and come back.
+#
+# Rather than moving configurations between processes we swap which κ each replica is simulating.
+# Each κ's chain of configurations is then written to the usual Ensemble storage, so that the Bootstrap and everything
+# downstream is unchanged.
+#
+# The replicas hand their configurations back through shared memory (see transport.py), so only the actions are pickled.
+
+def action(S, x):
+    return S(**getattr(x, 'fields', x))
+
+def replica(rows, index, start, descriptor, connection):
+    # A replica holds the actions and generators for every κ of its family and simulates whichever κ it is told to.
+    S = [steps.Action.of(row) for row in rows]
+    G = [steps.Generator.of(row) for row in rows]
+    x = start
+
+    with descriptor.attach() as shared:
+        while (command := connection.recv()) is not None:
+            if command[0] == 'advance':
+                for sweep in range(command[1]):
+                    x = G[index].step(x)
+                shared.write(transport.fields(x))
+                connection.send(np.array([action(s, x) for s in S]))
+            elif command[0] == 'assign':
+                index = command[1]
+
+# When the chains are written as Ensembles supervillain wants a generator that produced them.
+# A Replay generator replays the configurations the replicas produced and, after generation,
+# keeps only a summary of the tempering.
+class Replay(supervillain.h5.H5able):
+
+    def __init__(self, configurations, stride, kappas, acceptance):
+        self.configurations = deque(configurations)
+        self.stride = stride
+        self.kappas = kappas
+        self.acceptance = acceptance
+
+    def step(self, x):
+        return self.configurations.popleft()
+
+    def report(self):
+        return f'Parallel tempering over κ={self.kappas} every {self.stride} sweeps; swap acceptance {self.acceptance}.'
+
+def temper(family, rng=None):
+    r'''
+    Generates the production ensembles of every row in the family (which differ only in κ) by parallel tempering
+    and writes them to the rows' ensemble storage.
+
+    Each replica starts from its own κ's thermalized configuration.  Swaps are attempted every ``row['swap every']``
+    sweeps (default 1) and every κ records a configuration every ``row['record every']`` sweeps,
+    by default the largest thermalized τ of the family, rounded up to a whole number of swap attempts,
+    so that the recorded configurations are decorrelated even at the slowest κ.
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    rows = [row for idx, row in family.sort_values(by='kappa').iterrows()]
+    K = len(rows)
+
+    configurations = max(int(row['configurations']) for row in rows)
+    swap = rows[0].get('swap every', 1)
+    swap = 1 if pd.isna(swap) else int(swap)
+
+    thermalized = [steps.Thermalization.of(row) for row in rows]
+    starts = [T.configuration[-1] for T in thermalized]
+
+    # Recording every swap would give consecutive, strongly correlated sweeps; the Bootstrap would keep only one in τ of them.
+    record = rows[0].get('record every', np.nan)
+    record = int(np.ceil(max(T.tau for T in thermalized))) if pd.isna(record) else int(record)
+    rounds = max(1, int(np.ceil(record / swap)))
+    stride = rounds * swap
+
+    shared = [transport.Shared.like(transport.fields(start)) for start in starts]
+
+    connections, processes = [], []
+    for r, (row, start) in enumerate(zip(rows, starts)):
+        parent, child = Pipe()
+        p = Process(target=replica, args=(rows, r, start, shared[r].descriptor, child), daemon=True)
+        p.start()
+        # Only the replica holds its end, so that if it dies we see EOF rather than waiting forever.
+        child.close()
+        connections.append(parent)
+        processes.append(p)
+
+    def receive(r):
+        try:
+            return connections[r].recv()
+        except EOFError:
+            processes[r].join()
+            raise RuntimeError(f'The replica at κ={rows[r]["kappa"]} died with exit code {processes[r].exitcode}.') from None
+
+    # at[k] is the replica simulating the kth κ.
+    at = np.arange(K)
+    chains = [deque() for _ in rows]
+    accepted = np.zeros(K-1)
+    attempted = np.zeros(K-1)
+
+    attempt = 0
+    try:
+        # One extra configuration serves as each chain's starting point when we write the ensembles.
+        for configuration in steps.progress(range(configurations+1), desc='tempering'):
+            for _ in range(rounds):
+                for c in connections:
+                    c.send(('advance', swap))
+                actions = np.stack([receive(r) for r in range(K)])  # [replica, κ]
+
+                # Alternate between attempting (0,1), (2,3), ... and (1,2), (3,4), ...
+                for k in range(attempt % 2, K-1, 2):
+                    a, b = at[k], at[k+1]
+                    delta = actions[a, k+1] + actions[b, k] - actions[a, k] - actions[b, k+1]
+                    attempted[k] += 1
+                    if rng.uniform() < np.exp(-delta.real):
+                        at[k], at[k+1] = b, a
+                        accepted[k] += 1
+                attempt += 1
+
+                for k in range(K):
+                    connections[at[k]].send(('assign', k))
+
+            # Each replica has finished writing its configuration before sending its actions,
+            # and an assignment does not change the configuration.
+            for k in range(K):
+                chains[k].append(transport.rebuild(starts[at[k]], shared[at[k]].copy()))
+    finally:
+        for c in connections:
+            try:
+                c.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for p in processes:
+            p.join()
+        for s in shared:
+            s.close()
+
+    acceptance = accepted / np.maximum(attempted, 1)
+    logger.info(f'Swap acceptance between neighboring κ: {acceptance}')
+
+    kappas = np.array([row['kappa'] for row in rows])
+    for row, chain in zip(rows, chains):
+        S = steps.Action.of(row)
+        start = chain.popleft()
+        count = int(row['configurations'])
+        G = Replay(list(chain)[:count], stride, kappas, acceptance)
+
+        E = supervillain.Ensemble(S).generate(count, G, start=start)
+        # Don't store the replayed configurations a second time.
+        del G.configurations
+
+        steps.Ensemble.write(row, steps.Ensemble.measure(E, measurement.declared(row, 'ensemble')))
+
+family = ['W', 'N', 'action']
+
+def produce(ensembles):
+    with Timer(logger.info, f'Tempering {len(ensembles)} ensembles'):
+        for (W, N, action), rows in ensembles.groupby(family):
+            missing = rows[[steps.Possible(steps.Ensemble).of(row) is None for idx, row in rows.iterrows()]]
+            if missing.empty:
+                logger.info(f'Every ensemble for W={W} N={N} {action} already exists.')
+                continue
+            if len(missing) < len(rows):
+                logger.warning(f'Some ensembles for W={W} N={N} {action} exist; tempering only the other {len(missing)}.')
+            if len(missing) < 2:
+                logger.info(f'Only one κ for W={W} N={N} {action}; leaving it to the usual Ensemble step.')
+                continue
+
+            with Timer(logger.info, f'Tempering W={W} N={N} {action} over κ={tuple(missing["kappa"])}'):
+                temper(missing)
+
+if __name__ == '__main__':
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('input_file', type=supervillain.cli.input_file('input'), default='input.py')
+    parser.add_argument('--W', default=None, type=int)
+    parser.add_argument('--N', default=None, type=int)
+
+    args = parser.parse_args()
+
+    ensembles = args.input_file.ensembles
+    if args.W:
+        ensembles = ensembles[ensembles['W'] == args.W]
+    if args.N:
+        ensembles = ensembles[ensembles['N'] == args.N]
+
+    from tqdm.autonotebook import tqdm
+    from tqdm.contrib.logging import logging_redirect_tqdm
+    steps.progress = tqdm
+
+    with logging_redirect_tqdm():
+        produce(ensembles)
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import os
+import json
+import threading
+from contextlib import contextmanager
+from time import time, perf_counter, thread_time
+
+from supervillain.performance import Timer
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The Timers in the steps only write free-text log lines.
+# To see where a run spends its time we also record each timed block as a structured event
+#
+#   {step, path, phase, pid, tid, start, wall, cpu}
+#
+# one JSON object per line in a trace file.  Appending a short line is atomic, so every worker of a
+# --parallel run can append to the same file.  When no trace file is set, timed is just a Timer.
+#
+# The file is remembered in the environment so that worker processes inherit it however they are started.
+file = os.environ.get('SUPERVILLAIN_TRACE', None)
+
+def start(filename):
+    global file
+    file = filename
+    os.environ['SUPERVILLAIN_TRACE'] = filename
+
+@contextmanager
+def timed(log, message, step, phase, row=None):
+    r'''
+    Like ``Timer(log, message)``, but also records an event for the step and phase (for example prep, compute, read, or write)
+    of the row into the trace file, if there is one.
+    '''
+    if file is None:
+        with Timer(log, message):
+            yield
+        return
+
+    event = {
+        'step':  step,
+        'path':  None if row is None else row.get('path', None),
+        'phase': phase,
+        'pid':   os.getpid(),
+        # Some events happen on background threads (see results.prefetch), concurrently with the main thread's.
+        'tid':   threading.get_native_id(),
+        'start': time(),
+        }
+    wall, cpu = perf_counter(), thread_time()
+    try:
+        with Timer(log, message):
+            yield
+    except BaseException as e:
+        event['error'] = e.__class__.__name__
+        raise
+    finally:
+        event['wall'] = perf_counter() - wall
+        event['cpu']  = thread_time() - cpu
+        with open(file, 'a') as f:
+            f.write(json.dumps(event)+'\n')
+
+def read(filename):
+    import pandas as pd
+    with open(filename) as f:
+        return pd.DataFrame([json.loads(line) for line in f if line.strip()])
+
+# Events nest; constructing an Ensemble includes preparing its ingredients, which includes reading the Thermalization.
+# The self time of an event is its wall time less the wall time of the events directly inside it (in the same thread),
+# which is what tells us whether i/o or generation dominates.
+def threads(events):
+    # Traces written before events recorded their thread have one thread per process.
+    events = events.copy()
+    events['tid'] = events['tid'].fillna(events['pid']) if 'tid' in events else events['pid']
+    return events
+
+def self_time(events):
+    events = threads(events).sort_values(by=['pid', 'tid', 'start', 'wall'], ascending=[True, True, True, False])
+    events['self'] = events['wall']
+
+    for (pid, tid), thread in events.groupby(['pid', 'tid']):
+        stack = []
+        for idx, e in thread.iterrows():
+            end = e['start'] + e['wall']
+            while stack and stack[-1][1] <= e['start']:
+                stack.pop()
+            if stack:
+                events.loc[stack[-1][0], 'self'] -= e['wall']
+            stack.append((idx, end))
+
+    return events
+
+def summary(events):
+    events = self_time(events)
+    table = events.groupby(['step', 'phase']).agg(
+        count=('wall', 'size'),
+        wall=('wall', 'sum'),
+        self=('self', 'sum'),
+        cpu=('cpu', 'sum'),
+        longest=('wall', 'max'),
+        )
+    table['self %'] = 100 * table['self'] / table['self'].sum()
+    return table.sort_values(by='self', ascending=False)
+
+# Chrome's about:tracing and https://ui.perfetto.dev both understand the Trace Event Format,
+# where a complete event with ph='X' has a start and a duration in microseconds.
+def chrome(events):
+    events = threads(events)
+    return {
+        'displayTimeUnit': 'ms',
+        'traceEvents': [
+            {
+                'name': e['step'],
+                'cat':  e['phase'],
+                'ph':   'X',
+                'ts':   1e6 * e['start'],
+                'dur':  1e6 * e['wall'],
+                'pid':  int(e['pid']),
+                'tid':  int(e['tid']),
+                'args': {k: e[k] for k in ('path', 'phase', 'cpu', 'error') if k in e and e[k] == e[k]},
+            }
+            for idx, e in events.iterrows()
+        ]}
+
+if __name__ == '__main__':
+
+    import pandas as pd
+    import supervillain
+
+    parser = supervillain.cli.ArgumentParser()
+    parser.add_argument('trace', type=str, help='A trace file written with --trace.')
+    parser.add_argument('--chrome', default='', type=str, help='Write a Chrome / Perfetto trace to this file.')
+
+    args = parser.parse_args()
+
+    events = read(args.trace)
+
+    with pd.option_context('display.max_rows', None, 'display.width', 1000, 'display.float_format', '{:.3f}'.format):
+        print(summary(events))
+
+    if args.chrome:
+        with open(args.chrome, 'w') as f:
+            json.dump(chrome(events), f)
@@ -7,15 +7,33 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def transition(ax, data):
+# With reweighted data (see reweighting.py) on a dense grid of κ we can draw smooth bands between the simulated κ,
+# rather than joining them with straight lines.
+def transition(ax, data, dense=None):
 
     for N, dat in data.groupby('N'):
         for observable in ('VortexCriticalMoment', 'SpinCriticalMoment'):
-            line = ax.plot(
-                dat['kappa'], dat[observable],
-                marker='none', linestyle='-',
-                label=f'{observable} {N=}',
-                )
+            if dense is None or (d := dense[dense['N'] == N]).empty:
+                line = ax.plot(
+                    dat['kappa'], dat[observable],
+                    marker='none', linestyle='-',
+                    label=f'{observable} {N=}',
+                    )
+            else:
+                # Each action is reweighted separately, over the κ where it was simulated.
+                color = None
+                for action, da in d.groupby('action'):
+                    da = da.sort_values(by='kappa')
+                    line = ax.plot(
+                        da['kappa'], da[observable],
+                        marker='none', linestyle='-', color=color,
+                        label=(f'{observable} {N=}' if color is None else None),
+                        )
+                    color = line[0].get_color()
+                    ax.fill_between(
+                        da['kappa'], da[observable] - da[f'{observable}±'], da[observable] + da[f'{observable}±'],
+                        color=color, alpha=0.25, linewidth=0,
+                        )
 
             for action, da in dat.groupby('action'):
                 ax.errorbar(
@@ -29,7 +47,7 @@ def transition(ax, data):
     ax.legend(loc='upper right')
  
 
-def visualize(data):
+def visualize(data, dense=None):
 
     figs=deque()
 
@@ -37,7 +55,7 @@ def visualize(data):
         fig, ax = plt.subplots(1,1, figsize=(10, 8), sharex='col')
         fig.suptitle(f'{W=}', fontsize=24)
 
-        transition(ax, dat)
+        transition(ax, dat, None if dense is None or dense.empty else dense[dense['W'] == W])
 
         fig.tight_layout()
         figs.append(fig)
@@ -55,6 +73,7 @@ if __name__ == '__main__':
     parser.add_argument('input_file', type=supervillain.cli.input_file('input'), default='input.py')
     parser.add_argument('--parallel', default=False, action='store_true')
     parser.add_argument('--pdf', default='', type=str)
+    parser.add_argument('--reweight', default=0, type=int, help='Draw reweighted curves through this many κ.')
 
     args = parser.parse_args()
 
@@ -65,7 +84,11 @@ if __name__ == '__main__':
     print(ensembles)
 
     data = results.collect(ensembles)
-    figs = visualize(data)
+    dense = None
+    if args.reweight:
+        import reweighting
+        dense = reweighting.reweight(ensembles, ('VortexCriticalMoment', 'SpinCriticalMoment'), points=args.reweight)
+    figs = visualize(data, dense)
 
     if args.pdf:
         results.pdf(args.pdf, figs)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import sys
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Anything we send between processes through a Pipe or a Pool is pickled, copied through the kernel, and unpickled,
+# so that for a moment both processes hold a copy (and the pickle is a third).
+# For configurations and ensembles on big lattices that is both slow and a lot of memory.
+#
+# Instead the sender can put its arrays in named shared-memory segments and send only a Descriptor:
+# the name, shape, and dtype of each array, which is tiny.  The receiver attaches to the same segments
+# and sees the very same memory as numpy arrays, without any copy.
+#
+# Whoever allocates the segments owns them and must eventually unlink them; a Shared is a context manager that does so.
+
+class Descriptor(dict):
+    r'''
+    A picklable description of shared arrays, {name: (segment, shape, dtype)},
+    which also knows the pid of the owner's resource tracker.
+    '''
+
+    def __init__(self, arrays, tracker=None):
+        super().__init__(arrays)
+        self.tracker = tracker
+
+    def attach(self):
+        return Shared.attach(self)
+
+class Shared(dict):
+    r'''
+    A dictionary of numpy arrays that live in shared memory.
+
+    Allocate one with Shared.like(arrays) in one process, send its .descriptor to another,
+    and call Shared.attach(descriptor) (or descriptor.attach()) there.
+    '''
+
+    def __init__(self, arrays, segments, owner):
+        super().__init__(arrays)
+        self.segments = segments
+        self.owner = owner
+        self.descriptor = Descriptor({
+            name: (self.segments[name].name, array.shape, array.dtype.str)
+            for name, array in arrays.items()
+            }, tracker=tracker() if owner else None)
+
+    @classmethod
+    def like(cls, arrays):
+        r'''
+        Allocate shared arrays with the same names, shapes, and dtypes as the given arrays, and copy them in.
+        '''
+        segments, shared = dict(), dict()
+        for name, array in arrays.items():
+            array = np.asarray(array)
+            segments[name] = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            shared[name] = np.ndarray(array.shape, dtype=array.dtype, buffer=segments[name].buf)
+            shared[name][...] = array
+
+        return cls(shared, segments, owner=True)
+
+    @classmethod
+    def attach(cls, descriptor):
+        segments, shared = dict(), dict()
+        for name, (segment, shape, dtype) in descriptor.items():
+            if sys.version_info >= (3, 13):
+                segments[name] = shared_memory.SharedMemory(name=segment, track=False)
+            else:
+                segments[name] = shared_memory.SharedMemory(name=segment)
+                # Before python 3.13 attaching registers the segment with this process's resource tracker.
+                # Processes started by multiprocessing (forked or spawned) share the owner's tracker, whose registration
+                # is the owner's own and must stay.  Only a tracker of our own would unlink the segment out from under the owner.
+                if own_tracker(descriptor):
+                    resource_tracker.unregister(segments[name]._name, 'shared_memory')
+            shared[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=segments[name].buf)
+
+        return cls(shared, segments, owner=False)
+
+    def write(self, arrays):
+        # Copy new values into the shared arrays in place; the shapes and dtypes must not change.
+        for name, array in arrays.items():
+            self[name][...] = array
+
+    def copy(self):
+        # Ordinary (private) copies of the arrays, which outlive the segments.
+        return {name: np.array(array) for name, array in self.items()}
+
+    def close(self):
+        # The arrays are views of the segments and must go first.
+        self.clear()
+        for segment in self.segments.values():
+            segment.close()
+            if self.owner:
+                segment.unlink()
+        self.segments = dict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    @property
+    def nbytes(self):
+        return sum(array.nbytes for array in self.values())
+
+def tracker():
+    # The pid of the resource tracker this process started, or None if it uses one it inherited.
+    return getattr(resource_tracker._resource_tracker, '_pid', None)
+
+def own_tracker(descriptor):
+    # A spawned process inherits the tracker's pipe but not its pid; a forked one inherits both.
+    pid = tracker()
+    return pid is not None and pid != descriptor.tracker
+
+# Configurations may be dictionaries of fields or supervillain objects holding them in .fields.
+def fields(configuration):
+    return getattr(configuration, 'fields', configuration)
+
+def rebuild(template, new):
+    # A configuration like the template but with the new fields.
+    return new if fields(template) is template else template.__class__(new)